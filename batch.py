@@ -0,0 +1,290 @@
+# Headless grading of student rationales outside the Streamlit UI.
+#
+#   python -m batch responses.jsonl [--model gpt-4o] [--concurrency 8] [--rpm 300] [--output graded.jsonl]
+#   python -m batch responses.jsonl --batch-api openai      # provider Batch API, ~50% cheaper, asynchronous
+#   python -m batch responses.jsonl --pregrade local        # local similarity pre-grading only, no API calls
+#
+# Each input line is a JSON object with "case_id" (a DISEASE_GENERATOR id), "rationale" and optionally
+# "likert" (e.g. "+1 More likely") plus any other fields, which are copied to the output. Every rationale
+# goes through the rationale phase prompt of its case, with the same chat history the app would have
+# built by then; results are appended to the output JSONL as they complete. "score" is the model's total
+# against the rationale phase's rubric (0-4), from a second call next to the feedback call. With --pregrade
+# every rationale is first scored locally (see pregrade.py); "filter" only sends the ones PREGRADE leaves to
+# the LLM. Rows decided locally have "model": "pregrade" and the provisional score (0-1) as their "score".
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from config import CLIENT_POOL, LLM_CONFIGURATIONS, PREGRADE, RATE_LIMITS, SYSTEM_PROMPT, DISEASE_GENERATOR, build_phases, \
+    selected_llm
+from llm_adapters import AnthropicAdapter, OpenAIAdapter, completion_cost, get_adapter
+from llm_clients import registry_from_env
+from pregrade import SEND_BACK_VERDICTS, ReferenceIndex, local_feedback, pregrade_batch
+from rate_limit import RateLimitedAdapter, RateLimiterRegistry
+from scoring import build_scoring_instructions, extract_score, likert_matches
+
+GRADED_PHASE = "rationale"
+# Provider Batch APIs bill at half the synchronous price
+BATCH_API_DISCOUNT = 0.5
+USAGE_KEYS = ("input_tokens", "cached_tokens", "cache_write_tokens", "output_tokens")
+
+
+def build_request(submission):
+    # The prompts and history the app would send for this submission in the rationale phase
+    phases = build_phases(submission["case_id"])
+    phase = phases[GRADED_PHASE]
+    chat_history = [{"user": phases["about"]["user_prompt"], "assistant": phases["about"]["custom_response"]}]
+    if submission.get("likert"):
+        chat_history.append({"user": phases["likert"]["user_prompt"].format(likert=submission["likert"]),
+                             "assistant": phases["likert"]["custom_response"]})
+    return {
+        "system_prompt": SYSTEM_PROMPT + "\n" + phase["phase_instructions"],
+        "chat_history": chat_history,
+        "user_prompt": phase["user_prompt"].format(**{GRADED_PHASE: submission["rationale"]}),
+        # Scores the rationale against the phase's rubric, as the app's scoring call does; None without a rubric
+        "scoring_prompt": (SYSTEM_PROMPT + "\n" + build_scoring_instructions(phase["rubric"])
+                           if phase.get("rubric") else None),
+        # Precomputed expert content of the case, which the app shows before the model's feedback
+        "response_prefix": phase.get("response_prefix", ""),
+    }
+
+
+def total_usage(completions):
+    return {key: sum(completion.get(key, 0) for completion in completions) for key in USAGE_KEYS}
+
+
+def batch_prompts(index, request):
+    # (custom_id, system prompt) of the Batch API requests for one submission: its feedback and its score
+    prompts = [(str(index), request["system_prompt"])]
+    if request["scoring_prompt"]:
+        prompts.append((f"{index}-score", request["scoring_prompt"]))
+    return prompts
+
+
+def build_result(submission, llm_configuration, feedback=None, usage=None, score=None, error=None,
+                 latency=None, discount=1, model=None):
+    usage = usage or {}
+    case = DISEASE_GENERATOR[submission["case_id"]]
+    result = dict(submission)
+    result.update({
+        "model": model or llm_configuration["model"],
+        "expected_answer": case["answer"],
+        "likert_match": likert_matches(submission.get("likert"), case["answer"]) if submission.get("likert") else None,
+        "feedback": feedback,
+        "score": score,
+        "input_tokens": usage.get("input_tokens", 0),
+        "cached_tokens": usage.get("cached_tokens", 0),
+        "output_tokens": usage.get("output_tokens", 0),
+        "cost": completion_cost(llm_configuration, usage) * discount,
+        "latency": latency,
+        "error": error,
+    })
+    return result
+
+
+async def grade_submission(adapter, llm_configuration, submission, semaphore):
+    async with semaphore:
+        started = time.monotonic()
+        try:
+            request = build_request(submission)
+            calls = [adapter.complete(llm_configuration, request["system_prompt"], request["chat_history"],
+                                      request["user_prompt"])]
+            if request["scoring_prompt"]:
+                calls.append(adapter.complete(llm_configuration, request["scoring_prompt"], request["chat_history"],
+                                              request["user_prompt"]))
+            completions = await asyncio.gather(*calls)
+        except Exception as e:
+            return build_result(submission, llm_configuration, error=str(e))
+        usage = total_usage(completions)
+        score = extract_score(completions[1]["text"]) if len(completions) > 1 else None
+        return build_result(submission, llm_configuration, request["response_prefix"] + completions[0]["text"],
+                            usage, score,
+                            latency=time.monotonic() - started)
+
+
+async def grade_online(registry, llm_configuration, submissions, output, concurrency):
+    # Same rate limiting, retries and circuit breaker as the app
+    limiters = RateLimiterRegistry(RATE_LIMITS)
+    adapter = RateLimitedAdapter(get_adapter(llm_configuration["provider"], registry), limiters)
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [grade_submission(adapter, llm_configuration, submission, semaphore)
+             for submission in submissions]
+    for task in asyncio.as_completed(tasks):
+        write_result(output, await task)
+    print(json.dumps(limiters.stats()), file=sys.stderr)
+
+
+async def grade_openai_batch(registry, llm_configuration, submissions, output, poll_interval):
+    client = registry.get("openai", llm_configuration["model"])
+    adapter = OpenAIAdapter(registry)
+    lines = []
+    for index, submission in enumerate(submissions):
+        request = build_request(submission)
+        for custom_id, system_prompt in batch_prompts(index, request):
+            body = adapter.build_request(llm_configuration, system_prompt, request["chat_history"],
+                                         request["user_prompt"], None, False)
+            lines.append(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                                     "body": body}))
+    batch_file = await client.files.create(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+    batch = await client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions",
+                                        completion_window="24h")
+    print(f"OpenAI batch {batch.id} submitted", file=sys.stderr)
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(poll_interval)
+        batch = await client.batches.retrieve(batch.id)
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"OpenAI batch {batch.id} ended with status {batch.status}")
+
+    content = await client.files.content(batch.output_file_id)
+    completions = {}
+    errors = {}
+    for line in content.text.splitlines():
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") != 200:
+            errors[item["custom_id"]] = json.dumps(item.get("error"))
+            continue
+        body = response["body"]
+        response_usage = body["usage"]
+        cached_tokens = (response_usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        completions[item["custom_id"]] = {
+            "text": body["choices"][0]["message"]["content"],
+            "input_tokens": response_usage["prompt_tokens"] - cached_tokens,
+            "cached_tokens": cached_tokens,
+            "output_tokens": response_usage["completion_tokens"],
+        }
+    write_batch_results(output, llm_configuration, submissions, completions, errors)
+
+
+async def grade_anthropic_batch(registry, llm_configuration, submissions, output, poll_interval):
+    client = registry.get("anthropic", llm_configuration["model"])
+    adapter = AnthropicAdapter(registry)
+    requests = []
+    for index, submission in enumerate(submissions):
+        request = build_request(submission)
+        for custom_id, system_prompt in batch_prompts(index, request):
+            params = adapter.build_request(llm_configuration, system_prompt, request["chat_history"],
+                                           request["user_prompt"])
+            requests.append({"custom_id": custom_id, "params": params})
+    batch = await client.messages.batches.create(requests=requests)
+    print(f"Anthropic batch {batch.id} submitted", file=sys.stderr)
+    while batch.processing_status != "ended":
+        await asyncio.sleep(poll_interval)
+        batch = await client.messages.batches.retrieve(batch.id)
+
+    completions = {}
+    errors = {}
+    async for item in await client.messages.batches.results(batch.id):
+        if item.result.type != "succeeded":
+            errors[item.custom_id] = item.result.type
+            continue
+        completions[item.custom_id] = adapter.to_completion(item.result.message)
+    write_batch_results(output, llm_configuration, submissions, completions, errors)
+
+
+def write_batch_results(output, llm_configuration, submissions, completions, errors):
+    # completions and errors are keyed by the custom_ids from batch_prompts. A failed scoring request leaves
+    # the score empty; a failed feedback request fails the whole row
+    for index, submission in enumerate(submissions):
+        feedback = completions.get(str(index))
+        if feedback is None:
+            write_result(output, build_result(submission, llm_configuration,
+                                              error=errors.get(str(index), "missing from the batch output")))
+            continue
+        scoring = completions.get(f"{index}-score")
+        write_result(output, build_result(submission, llm_configuration,
+                                          build_request(submission)["response_prefix"] + feedback["text"],
+                                          total_usage([completion for completion in (feedback, scoring) if completion]),
+                                          extract_score(scoring["text"]) if scoring else None,
+                                          discount=BATCH_API_DISCOUNT))
+
+
+def pregrade_submissions(llm_configuration, submissions, output, local_only):
+    # Scores every submission locally in one vectorized pass and writes the results decided locally;
+    # returns the submissions that still need the LLM, each carrying its "pregrade" result
+    started = time.monotonic()
+    cases = [DISEASE_GENERATOR[submission["case_id"]] for submission in submissions]
+    likerts = [submission.get("likert") for submission in submissions]
+    index = ReferenceIndex(DISEASE_GENERATOR.scan())
+    results = pregrade_batch(index, cases, likerts, [submission["rationale"] for submission in submissions], PREGRADE)
+    local_verdicts = set(SEND_BACK_VERDICTS) | set(PREGRADE.get("local_feedback", []))
+    remaining = []
+    verdicts = {}
+    for submission, case, likert, result in zip(submissions, cases, likerts, results):
+        verdicts[result["verdict"]] = verdicts.get(result["verdict"], 0) + 1
+        submission = dict(submission, pregrade=result)
+        if local_only or result["verdict"] in local_verdicts:
+            write_result(output, build_result(submission, llm_configuration, local_feedback(result, case, likert),
+                                              score=result["provisional_score"], model="pregrade"))
+        else:
+            remaining.append(submission)
+    print(f"Pregraded {len(submissions)} submissions in {time.monotonic() - started:.2f} s: {json.dumps(verdicts)}, "
+          f"{len(remaining)} left for the LLM", file=sys.stderr)
+    return remaining
+
+
+def write_result(output, result):
+    output.write(json.dumps(result, ensure_ascii=False) + "\n")
+    output.flush()
+
+
+def read_submissions(path):
+    with open(path, encoding="utf-8") as input_file:
+        submissions = [json.loads(line) for line in input_file if line.strip()]
+    for line_number, submission in enumerate(submissions, start=1):
+        if submission.get("case_id") not in DISEASE_GENERATOR or "rationale" not in submission:
+            raise ValueError(f"Line {line_number}: expected a known case_id and a rationale")
+    return submissions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Grade student rationales without the Streamlit UI.")
+    parser.add_argument("input", help="JSONL file with case_id, rationale and optionally likert per line")
+    parser.add_argument("--output", help="JSONL file to append results to (default: <input>.graded.jsonl)")
+    parser.add_argument("--model", default=selected_llm, choices=sorted(LLM_CONFIGURATIONS),
+                        help="Key in LLM_CONFIGURATIONS")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum requests in flight")
+    parser.add_argument("--rpm", type=float, help="Requests per minute (default: the model's rpm_limit)")
+    parser.add_argument("--tpm", type=float, help="Tokens per minute (default: the model's tpm_limit)")
+    parser.add_argument("--batch-api", choices=("openai", "anthropic"),
+                        help="Submit through the provider Batch API instead of live calls")
+    parser.add_argument("--poll-interval", type=float, default=30, help="Seconds between Batch API status checks")
+    parser.add_argument("--pregrade", choices=("local", "filter"),
+                        help="Score rationales locally first: \"local\" only, or \"filter\" to send just the "
+                             "ones PREGRADE does not decide to the LLM")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    load_dotenv()
+    args = parse_args(argv)
+    llm_configuration = dict(LLM_CONFIGURATIONS[args.model])
+    if args.rpm is not None:
+        llm_configuration["rpm_limit"] = args.rpm
+    if args.tpm is not None:
+        llm_configuration["tpm_limit"] = args.tpm
+    if args.batch_api and args.batch_api != llm_configuration["provider"]:
+        raise SystemExit(f"--batch-api {args.batch_api} needs a {args.batch_api} model, got {args.model}")
+    submissions = read_submissions(args.input)
+    registry = registry_from_env(CLIENT_POOL)
+    with open(args.output or args.input + ".graded.jsonl", "a", encoding="utf-8") as output:
+        if args.pregrade:
+            submissions = pregrade_submissions(llm_configuration, submissions, output, args.pregrade == "local")
+            if not submissions:
+                return
+        if args.batch_api == "openai":
+            run = grade_openai_batch(registry, llm_configuration, submissions, output, args.poll_interval)
+        elif args.batch_api == "anthropic":
+            run = grade_anthropic_batch(registry, llm_configuration, submissions, output, args.poll_interval)
+        else:
+            run = grade_online(registry, llm_configuration, submissions, output, args.concurrency)
+        asyncio.run(run)
+
+
+if __name__ == "__main__":
+    main()
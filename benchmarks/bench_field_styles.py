@@ -0,0 +1,65 @@
+# Compares a stylable_container per field (the old build_field) with one shared style element,
+# by the number of elements sent to the frontend and the script run time, for a page of 24 fields.
+#
+#   python -m benchmarks.bench_field_styles
+
+import time
+
+from streamlit.testing.v1 import AppTest
+
+# AppTest.from_function only ships the function source, so the scripts below repeat the field count
+FIELD_COUNT = 24
+RUNS = 20
+
+
+def per_field_containers():
+    import streamlit as st
+    from streamlit_extras.stylable_container import stylable_container
+
+    for index in range(24):
+        with stylable_container(
+                key="large_label",
+                css_styles="""
+                label p {
+                    font-weight: bold;
+                    font-size: 16px;
+                }
+
+                div[role="radiogroup"] label p{
+                    font-weight: unset !important;
+                    font-size: unset !important;
+                }
+                """,
+        ):
+            st.text_input(label=f"Question {index}", key=f"field_{index}")
+
+
+def shared_style():
+    import streamlit as st
+    from rendering import inject_field_styles
+
+    inject_field_styles()
+    for index in range(24):
+        st.text_input(label=f"Question {index}", key=f"field_{index}")
+
+
+def count_elements(node):
+    children = getattr(node, "children", {})
+    return 1 + sum(count_elements(child) for child in children.values())
+
+
+def main():
+    print(f"{FIELD_COUNT} fields, {RUNS} runs")
+    print(f"{'approach':<24}{'elements':>10}{'ms/run':>10}")
+    for name, script in (("stylable_container", per_field_containers), ("shared style", shared_style)):
+        app = AppTest.from_function(script)
+        app.run()
+        started = time.perf_counter()
+        for _ in range(RUNS):
+            app.run()
+        run_ms = (time.perf_counter() - started) * 1000 / RUNS
+        print(f"{name:<24}{count_elements(app.main):>10}{run_ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
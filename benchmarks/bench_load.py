@@ -0,0 +1,203 @@
+# Load test of the whole app against benchmarks/fake_llm_server.py, so capacity can be measured without
+# paid API calls. Each student is an AppTest session going through about -> likert -> rationale; sessions
+# run concurrently in this process like sessions on one Streamlit server, sharing its cached resources.
+# Reports script run time per step, session state size, throughput and the app's own per-phase LLM
+# latencies (see telemetry.py).
+#
+#   python -m benchmarks.bench_load --students 50 --concurrency 10 --model gpt-4o --latency 0.8 --error-rate 0.02
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit.testing.v1.app_test as app_test
+from streamlit import config as streamlit_config
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest
+
+import config
+from benchmarks.fake_llm_server import add_settings_arguments, settings_from_args, start_server
+from debug_panel import session_snapshot
+from llm_clients import API_KEY_VARIABLES
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+STEPS = ("load", "about", "likert", "rationale")
+RATIONALE = ("The new finding is more typical of the initial diagnosis than of the alternatives, "
+             "so it raises my estimate of its probability.")
+
+
+class CallCollector(logging.Handler):
+    # Collects the app's per-call telemetry records instead of printing them
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def emit(self, record):
+        self.calls.append(json.loads(record.getMessage()))
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def point_app_at(base_url, use_cache):
+    # main.py does `from config import *` on every run, so changing these dicts in place reaches the app
+    config.CLIENT_POOL["openai"] = dict(config.CLIENT_POOL.get("openai", {}), base_url=base_url + "/v1")
+    config.CLIENT_POOL["anthropic"] = dict(config.CLIENT_POOL.get("anthropic", {}), base_url=base_url)
+    config.CLIENT_POOL["gemini"] = dict(config.CLIENT_POOL.get("gemini", {}), transport="rest", base_url=base_url)
+    config.TELEMETRY["metrics_port"] = None
+    # Test students must not end up in the real session store
+    config.SESSION_STORE["enabled"] = False
+    # Fake spend must not count against the real cohorts in budget.sqlite3
+    config.BUDGET["enabled"] = False
+    config.RESPONSE_CACHE["enabled"] = use_cache
+    for variable in API_KEY_VARIABLES.values():
+        os.environ[variable] = "fake-key"
+
+
+def share_test_runtime():
+    # AppTest installs a mock Runtime for each script run and removes it when the run ends. With students running
+    # concurrently, one run ending would pull the runtime from under the others ("Runtime hasn't been created!"),
+    # so once a run has installed one it stays available
+    installed = {}
+
+    def instance(cls):
+        if cls._instance is not None:
+            installed["runtime"] = cls._instance
+        if "runtime" not in installed:
+            raise RuntimeError("Runtime hasn't been created!")
+        return installed["runtime"]
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or "runtime" in installed)
+
+
+def share_test_config():
+    # AppTest also switches the process-wide "global.appTest" option on for each run and back off when the run
+    # ends, which would stop the other students' runs from recording their widgets mid-run (KeyError on a
+    # widget id). So it is switched on once for the whole load test and left alone
+    streamlit_config.get_config_options()
+    streamlit_config._set_option("global.appTest", True, "bench_load")
+    app_test.patch_config_options = lambda config_options: contextlib.nullcontext()
+
+
+def share_script_bytecode():
+    # AppTest compiles main.py afresh for every run, where a Streamlit server compiles it once for all sessions;
+    # CPython 3.11's parser also fails when several threads compile at once ("AST constructor recursion depth
+    # mismatch"). So the script is compiled once, under a lock, and shared by every student
+    get_bytecode = ScriptCache.get_bytecode
+    lock = threading.Lock()
+    compiled = {}
+
+    def shared_get_bytecode(script_cache, script_path):
+        with lock:
+            if script_path not in compiled:
+                compiled[script_path] = get_bytecode(script_cache, script_path)
+            return compiled[script_path]
+
+    ScriptCache.get_bytecode = shared_get_bytecode
+
+
+def find_widget(widgets, label_start):
+    return next(widget for widget in widgets if widget.label.startswith(label_start))
+
+
+def run_student(student, model, timeout):
+    timings = {}
+    at = AppTest.from_file(MAIN_SCRIPT, default_timeout=timeout)
+    at.query_params["seed"] = str(student)
+    at.session_state["selected_llm"] = model
+
+    def step(name, action):
+        started = time.perf_counter()
+        action()
+        timings[name] = time.perf_counter() - started
+        if at.exception:
+            raise RuntimeError(f"{name}: {at.exception[0].message}")
+
+    try:
+        step("load", at.run)
+        step("about", lambda: at.button(key="submit 0").click().run())
+        find_widget(at.selectbox, "Would the new information").select("+1 More likely")
+        step("likert", lambda: at.button(key="submit 1").click().run())
+        find_widget(at.text_area, "Please provide written justification").input(RATIONALE)
+        step("rationale", lambda: at.button(key="submit 2").click().run())
+    except Exception as e:
+        return {"timings": timings, "error": f"{type(e).__name__}: {e}"}
+    session_bytes = sum(size for size, _ in session_snapshot(at.session_state).values())
+    return {"timings": timings, "session_bytes": session_bytes, "error": None}
+
+
+def report(results, calls, wall_seconds, settings):
+    completed = [result for result in results if not result["error"]]
+    print(f"{len(completed)}/{len(results)} students completed in {wall_seconds:.1f} s "
+          f"({len(completed) / wall_seconds * 60:.1f} students/min)")
+    for result in results:
+        if result["error"]:
+            print(f"  failed: {result['error']}")
+
+    print(f"\n{'step':<12}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name in STEPS:
+        values = [result["timings"][name] * 1000 for result in results if name in result["timings"]]
+        print(f"{name:<12}{percentile(values, 0.5):>10.0f}{percentile(values, 0.95):>10.0f}{max(values or [0]):>10.0f}")
+
+    sizes = [result["session_bytes"] / 1024 for result in completed]
+    if sizes:
+        print(f"\nsession state: {sum(sizes) / len(sizes):.1f} KB mean, {max(sizes):.1f} KB max")
+
+    print(f"\n{'LLM calls':<40}{'calls':>7}{'errors':>8}{'p50 s':>8}{'p95 s':>8}{'ttft p95':>10}{'queue p95':>11}")
+    groups = {}
+    for call in calls:
+        groups.setdefault(f"{call['phase']} {call['provider']}/{call['model']}", []).append(call)
+    for name, group in sorted(groups.items()):
+        ok = [call for call in group if call["status"] == "ok"]
+        latencies = [call["latency_seconds"] for call in ok]
+        ttfts = [call["ttft_seconds"] for call in ok if call.get("ttft_seconds") is not None]
+        queues = [call["queue_seconds"] for call in ok if call.get("queue_seconds") is not None]
+        print(f"{name:<40}{len(group):>7}{len(group) - len(ok):>8}{percentile(latencies, 0.5):>8.2f}"
+              f"{percentile(latencies, 0.95):>8.2f}{percentile(ttfts, 0.95):>10.2f}{percentile(queues, 0.95):>11.2f}")
+    print(f"\nfake server: {settings.requests} requests, {settings.errors} injected errors")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app with concurrent AppTest students.")
+    parser.add_argument("--students", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5, help="Students in the app at the same time")
+    parser.add_argument("--model", default=config.selected_llm, choices=sorted(config.LLM_CONFIGURATIONS))
+    parser.add_argument("--cache", action="store_true", help="Keep the response cache enabled")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds allowed per script run")
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    settings = settings_from_args(args)
+    server = start_server(settings)
+    point_app_at(f"http://127.0.0.1:{server.server_address[1]}", args.cache)
+    share_test_runtime()
+    share_test_config()
+    share_script_bytecode()
+    collector = CallCollector()
+    call_logger = logging.getLogger("msct.llm")
+    call_logger.addHandler(collector)
+    call_logger.setLevel(logging.INFO)
+    call_logger.propagate = False
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="student") as executor:
+        results = list(executor.map(lambda student: run_student(student, args.model, args.timeout),
+                                    range(args.students)))
+    wall_seconds = time.perf_counter() - started
+    server.shutdown()
+    report(results, collector.calls, wall_seconds, settings)
+
+
+if __name__ == "__main__":
+    main()
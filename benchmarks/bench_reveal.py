@@ -0,0 +1,90 @@
+# Compares the ways a custom_response can be revealed by server CPU time and the number and size of the
+# frontend messages (ForwardMsgs) each one sends. Every mode runs inside a real Streamlit script run
+# (AppTest), so "write_stream" goes through st.write_stream itself.
+#
+#   python -m benchmarks.bench_reveal
+
+import time
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from streamlit.testing.v1 import AppTest
+
+from config import DISEASE_GENERATOR
+from rendering import reveal_message
+
+REPEATS = 50
+
+
+def reveal_per_character(res_box, message):
+    # The original typewriter loop
+    result = ""
+    for char in message:
+        result += char
+        res_box.info(body=result, icon="🤖")
+
+
+def reveal_with(reveal_config):
+    def reveal(res_box, message):
+        reveal_message(res_box, message, dict(reveal_config, frame_rate=0))
+    return reveal
+
+
+MODES = {
+    "per_character (old)": reveal_per_character,
+    "instant": reveal_with({"mode": "instant"}),
+    "chunked/word": reveal_with({"mode": "chunked", "unit": "word"}),
+    "chunked/sentence": reveal_with({"mode": "chunked", "unit": "sentence"}),
+    "write_stream/word": reveal_with({"mode": "write_stream", "unit": "word"}),
+    "write_stream/sentence": reveal_with({"mode": "write_stream", "unit": "sentence"}),
+}
+
+
+def measure_modes(message, repeats):
+    # Runs in the AppTest script thread; counts every message the script run sends per mode
+    ctx = get_script_run_ctx()
+    enqueue = ctx.enqueue
+    results = {}
+    try:
+        for name, reveal in MODES.items():
+            counts = {"messages": 0, "payload_bytes": 0}
+
+            def counting_enqueue(msg):
+                counts["messages"] += 1
+                counts["payload_bytes"] += msg.ByteSize()
+                enqueue(msg)
+
+            ctx.enqueue = counting_enqueue
+            started = time.process_time()
+            for _ in range(repeats):
+                reveal(st.empty(), message)
+            results[name] = dict(counts, cpu_seconds=time.process_time() - started)
+    finally:
+        ctx.enqueue = enqueue
+    return results
+
+
+def reveal_script():
+    import streamlit as st
+    from benchmarks.bench_reveal import measure_modes
+
+    st.session_state["results"] = measure_modes(st.session_state["message"], st.session_state["repeats"])
+
+
+def main():
+    message = max((case["case"] for case in DISEASE_GENERATOR.values()), key=len)
+    at = AppTest.from_function(reveal_script, default_timeout=600)
+    at.session_state["message"] = message
+    at.session_state["repeats"] = REPEATS
+    at.run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    print(f"Message length: {len(message)} characters, {REPEATS} repeats")
+    print(f"{'mode':<24}{'cpu ms/reveal':>15}{'messages':>10}{'payload KB':>12}")
+    for name, result in at.session_state["results"].items():
+        print(f"{name:<24}{result['cpu_seconds'] * 1000 / REPEATS:>15.3f}{result['messages'] // REPEATS:>10}"
+              f"{result['payload_bytes'] / REPEATS / 1024:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
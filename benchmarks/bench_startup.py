@@ -0,0 +1,64 @@
+# Cold-start cost of the provider SDKs: import time (from -X importtime) and peak RSS of a fresh
+# interpreter importing all providers, each provider alone, and the app's own LLM modules.
+#
+#   python -m benchmarks.bench_startup
+
+import re
+import subprocess
+import sys
+
+SCENARIOS = {
+    "interpreter only": [],
+    "openai": ["openai"],
+    "anthropic": ["anthropic"],
+    "gemini": ["google.generativeai"],
+    "all providers": ["openai", "google.generativeai", "anthropic"],
+    # With lazy imports these must not pull in any SDK
+    "llm_clients + llm_adapters": ["llm_clients", "llm_adapters"],
+}
+
+SDK_MODULES = ("openai", "anthropic", "google.generativeai")
+
+CHILD_SCRIPT = """
+import resource, sys, time
+started = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+elapsed_ms = (time.perf_counter() - started) * 1000
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+rss_mb = max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+sdks = [name for name in {sdk_modules!r} if name in sys.modules]
+print(f"{{elapsed_ms:.1f}} {{rss_mb:.1f}} {{','.join(sdks) or '-'}}")
+"""
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+\d+\s+\|\s+(\d+)\s+\| ( *)(\S+)")
+
+
+def importtime_ms(stderr, modules):
+    # Cumulative time of the requested top-level imports as reported by -X importtime
+    total_us = 0
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match and not match.group(2) and match.group(3) in modules:
+            total_us += int(match.group(1))
+    return total_us / 1000
+
+
+def run_scenario(modules):
+    script = CHILD_SCRIPT.format(modules=modules, sdk_modules=SDK_MODULES)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", script],
+                            capture_output=True, text=True, check=True)
+    elapsed_ms, rss_mb, sdks = result.stdout.split()
+    return float(elapsed_ms), importtime_ms(result.stderr, modules), float(rss_mb), sdks
+
+
+def main():
+    print(f"{'scenario':<28}{'wall ms':>10}{'importtime ms':>15}{'max RSS MB':>12}  SDKs loaded")
+    for name, modules in SCENARIOS.items():
+        elapsed_ms, import_ms, rss_mb, sdks = run_scenario(modules)
+        print(f"{name:<28}{elapsed_ms:>10.1f}{import_ms:>15.1f}{rss_mb:>12.1f}  {sdks}")
+
+
+if __name__ == "__main__":
+    main()
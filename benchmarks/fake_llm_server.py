@@ -0,0 +1,258 @@
+# Local stand-in for the OpenAI, Anthropic and Gemini HTTP APIs, for load tests that must not hit paid
+# endpoints. Answers chat requests in each provider's wire format (plain and streamed), after a
+# configurable time to first token, at a configurable token rate, and fails a configurable share of
+# requests with 429 or 500.
+#
+#   python -m benchmarks.fake_llm_server --port 8765 --latency 0.8 --tokens-per-second 60 --error-rate 0.02
+#
+# Point the app at it through CLIENT_POOL in config.py:
+#   "openai": {"base_url": "http://127.0.0.1:8765/v1"},
+#   "anthropic": {"base_url": "http://127.0.0.1:8765"},
+#   "gemini": {"transport": "rest", "base_url": "http://127.0.0.1:8765"},
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_TEXT = ("**Feedback** Your rationale identifies the key finding and weighs it against the initial "
+               "diagnosis. Consider how the new information changes the pretest probability and which "
+               "alternative explanations remain. ")
+GEMINI_PATH = re.compile(r"^/v1beta/models/([^:/]+):(generateContent|streamGenerateContent)")
+
+
+class FakeLLMSettings:
+    def __init__(self, latency=0.5, latency_jitter=0.2, tokens_per_second=50, output_tokens=120, error_rate=0.0,
+                 error_status=429, retry_after=None, seed=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def draw(self):
+        # (fail?, time to first token) for one request
+        with self._lock:
+            self.requests += 1
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            delay = max(0.0, self.random.gauss(self.latency, self.latency * self.latency_jitter))
+        return fail, delay
+
+    def words(self):
+        words = SAMPLE_TEXT.split()
+        return [words[index % len(words)] + " " for index in range(self.output_tokens)]
+
+
+def estimate_input_tokens(body):
+    return max(1, len(json.dumps(body)) // 4)
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = FakeLLMSettings()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = self.path.split("?")[0]
+        fail, delay = self.settings.draw()
+        if path.endswith("/chat/completions"):
+            provider = "openai"
+        elif path.endswith("/messages"):
+            provider = "anthropic"
+        elif GEMINI_PATH.match(path):
+            provider = "gemini"
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {path}"}})
+            return
+        time.sleep(delay)
+        if fail:
+            self.send_error_response(provider)
+            return
+        input_tokens = estimate_input_tokens(body)
+        if provider == "openai":
+            self.openai(body, input_tokens)
+        elif provider == "anthropic":
+            self.anthropic(body, input_tokens)
+        else:
+            match = GEMINI_PATH.match(path)
+            self.gemini(match.group(1), match.group(2) == "streamGenerateContent", input_tokens)
+
+    def send_error_response(self, provider):
+        status = self.settings.error_status
+        message = "Rate limit exceeded (injected)" if status == 429 else "Internal error (injected)"
+        if provider == "openai":
+            payload = {"error": {"message": message, "type": "rate_limit_error" if status == 429 else "server_error"}}
+        elif provider == "anthropic":
+            payload = {"type": "error", "error": {"type": "rate_limit_error" if status == 429 else "api_error",
+                                                  "message": message}}
+        else:
+            payload = {"error": {"code": status, "message": message,
+                                 "status": "RESOURCE_EXHAUSTED" if status == 429 else "INTERNAL"}}
+        headers = {"Retry-After": str(self.settings.retry_after)} if self.settings.retry_after else {}
+        self.send_json(status, payload, headers)
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def send_event(self, data, event=None):
+        text = (f"event: {event}\n" if event else "") + f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n"
+        encoded = text.encode("utf-8")
+        self.wfile.write(f"{len(encoded):x}\r\n".encode("ascii") + encoded + b"\r\n")
+        self.wfile.flush()
+
+    def end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def stream_words(self):
+        # Yields the response word by word, paced at tokens_per_second
+        interval = 1 / self.settings.tokens_per_second if self.settings.tokens_per_second else 0
+        for word in self.settings.words():
+            yield word
+            if interval:
+                time.sleep(interval)
+
+    def openai(self, body, input_tokens):
+        model = body.get("model", "")
+        output_tokens = self.settings.output_tokens
+        usage = {"prompt_tokens": input_tokens, "completion_tokens": output_tokens,
+                 "total_tokens": input_tokens + output_tokens, "prompt_tokens_details": {"cached_tokens": 0}}
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": model}
+        if not body.get("stream"):
+            time.sleep(output_tokens / self.settings.tokens_per_second if self.settings.tokens_per_second else 0)
+            self.send_json(200, dict(base, object="chat.completion", usage=usage, choices=[{
+                "index": 0, "message": {"role": "assistant", "content": "".join(self.settings.words())},
+                "finish_reason": "stop"}]))
+            return
+        chunk = dict(base, object="chat.completion.chunk")
+        self.start_stream()
+        self.send_event(dict(chunk, choices=[{"index": 0, "delta": {"role": "assistant", "content": ""},
+                                              "finish_reason": None}]))
+        for word in self.stream_words():
+            self.send_event(dict(chunk, choices=[{"index": 0, "delta": {"content": word}, "finish_reason": None}]))
+        self.send_event(dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self.send_event(dict(chunk, choices=[], usage=usage))
+        self.send_event("[DONE]")
+        self.end_stream()
+
+    def anthropic(self, body, input_tokens):
+        output_tokens = self.settings.output_tokens
+        message = {"id": "msg_fake", "type": "message", "role": "assistant", "model": body.get("model", ""),
+                   "stop_reason": "end_turn", "stop_sequence": None,
+                   "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                             "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0}}
+        if not body.get("stream"):
+            time.sleep(output_tokens / self.settings.tokens_per_second if self.settings.tokens_per_second else 0)
+            self.send_json(200, dict(message, content=[{"type": "text", "text": "".join(self.settings.words())}]))
+            return
+        self.start_stream()
+        self.send_event({"type": "message_start", "message": dict(
+            message, content=[], stop_reason=None, usage=dict(message["usage"], output_tokens=1))}, "message_start")
+        self.send_event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+                        "content_block_start")
+        for word in self.stream_words():
+            self.send_event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": word}},
+                            "content_block_delta")
+        self.send_event({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        self.send_event({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                         "usage": {"output_tokens": output_tokens}}, "message_delta")
+        self.send_event({"type": "message_stop"}, "message_stop")
+        self.end_stream()
+
+    def gemini(self, model, stream, input_tokens):
+        output_tokens = self.settings.output_tokens
+        usage = {"promptTokenCount": input_tokens, "candidatesTokenCount": output_tokens,
+                 "totalTokenCount": input_tokens + output_tokens}
+
+        def candidate(text, finished):
+            result = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+            if finished:
+                result["finishReason"] = "STOP"
+            return result
+
+        if not stream:
+            time.sleep(output_tokens / self.settings.tokens_per_second if self.settings.tokens_per_second else 0)
+            self.send_json(200, {"candidates": [candidate("".join(self.settings.words()), True)],
+                                 "usageMetadata": usage, "modelVersion": model})
+            return
+        self.start_stream()
+        words = list(self.stream_words())
+        # Gemini streams a few words per chunk and reports usage on the last one
+        for start in range(0, len(words), 8):
+            last = start + 8 >= len(words)
+            chunk = {"candidates": [candidate("".join(words[start:start + 8]), last)], "modelVersion": model}
+            if last:
+                chunk["usageMetadata"] = usage
+            self.send_event(chunk)
+        self.end_stream()
+
+
+def start_server(settings, host="127.0.0.1", port=0):
+    # Returns the running server; server.server_address[1] is the port when 0 was asked for
+    handler = type("ConfiguredFakeLLMHandler", (FakeLLMHandler,), {"settings": settings})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-llm-server", daemon=True).start()
+    return server
+
+
+def add_settings_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.5, help="Mean seconds to the first token")
+    parser.add_argument("--latency-jitter", type=float, default=0.2, help="Standard deviation as a share of latency")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="Output token rate (0: instant)")
+    parser.add_argument("--output-tokens", type=int, default=120, help="Tokens per response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests that fail")
+    parser.add_argument("--error-status", type=int, default=429, choices=(429, 500, 503), help="Status of failures")
+    parser.add_argument("--retry-after", type=float, help="Retry-After seconds sent with failures")
+    parser.add_argument("--seed", type=int, help="Seed for latency and error draws")
+
+
+def settings_from_args(args):
+    return FakeLLMSettings(args.latency, args.latency_jitter, args.tokens_per_second, args.output_tokens,
+                           args.error_rate, args.error_status, args.retry_after, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI/Anthropic/Gemini server for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    server = start_server(settings_from_args(args), args.host, args.port)
+    print(f"Fake LLM server on http://{args.host}:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import threading
+
+from context_window import estimate_tokens, history_tokens
+from llm_adapters import completion_cost
+from storage import build_backend, connect_shared
+
+
+class MemoryLedger:
+    # Spend per cohort in this worker process
+
+    def __init__(self, **kwargs):
+        self._lock = threading.Lock()
+        self._spent = {}
+
+    def spent(self, cohort):
+        with self._lock:
+            return self._spent.get(cohort, 0.0)
+
+    def add(self, cohort, cost):
+        with self._lock:
+            self._spent[cohort] = self._spent.get(cohort, 0.0) + cost
+
+    def reserve(self, cohort, cost, limit):
+        # Adds cost only if it keeps the cohort's spend within limit (None for no limit); True if it did
+        with self._lock:
+            spent = self._spent.get(cohort, 0.0)
+            if limit is not None and spent + cost > limit:
+                return False
+            self._spent[cohort] = spent + cost
+            return True
+
+
+class SQLiteLedger:
+    # Spend per cohort in an SQLite file, so every worker on the host counts against the same ceiling
+
+    def __init__(self, path="budget.sqlite3", **kwargs):
+        self._lock = threading.Lock()
+        self._conn = connect_shared(
+            path, "CREATE TABLE IF NOT EXISTS cohort_spend (cohort TEXT PRIMARY KEY, spent REAL NOT NULL)")
+
+    def spent(self, cohort):
+        with self._lock:
+            row = self._conn.execute("SELECT spent FROM cohort_spend WHERE cohort = ?", (cohort,)).fetchone()
+        return row[0] if row else 0.0
+
+    def add(self, cohort, cost):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO cohort_spend (cohort, spent) VALUES (?, ?) "
+                "ON CONFLICT (cohort) DO UPDATE SET spent = spent + excluded.spent", (cohort, cost))
+
+    def reserve(self, cohort, cost, limit):
+        # One statement, so workers reserving at the same time cannot both pass against the same spend
+        if limit is None:
+            self.add(cohort, cost)
+            return True
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO cohort_spend (cohort, spent) SELECT ?, ? WHERE ? <= ? "
+                "ON CONFLICT (cohort) DO UPDATE SET spent = spent + excluded.spent "
+                "WHERE spent + excluded.spent <= ?", (cohort, cost, cost, limit, limit))
+        return cursor.rowcount == 1
+
+
+LEDGER_BACKENDS = {
+    "memory": MemoryLedger,
+    "sqlite": SQLiteLedger,
+}
+
+
+def build_ledger(budget_config):
+    return build_backend(LEDGER_BACKENDS, budget_config, "budget ledger", "memory")
+
+
+class SessionBudget:
+    # One session's spend against the ceilings. A call reserves its worst-case cost (see worst_case_cost) before
+    # it is dispatched and settles to its real cost when it ends, so a session's parallel calls and the sessions
+    # of a cohort cannot all pass against the same remaining budget. Reserved cost counts as spent in the ledger
+    # until it settles. Calls settle on the event loop thread, hence the session's spend is kept here.
+
+    def __init__(self, budget_config, ledger, cohort, spent=0.0):
+        self.budget_config = budget_config
+        self.ledger = ledger
+        self.cohort = cohort
+        self.spent = spent
+        self.reserved = 0.0
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        with self._lock:
+            session_spent = self.spent + self.reserved
+        return remaining_budget(self.budget_config, session_spent, self.ledger.spent(self.cohort))
+
+    def reserve(self, cost):
+        # True if cost fits under both ceilings and is now reserved
+        with self._lock:
+            session_usd = self.budget_config.get("session_usd")
+            if session_usd is not None and self.spent + self.reserved + cost > session_usd:
+                return False
+            if not self.ledger.reserve(self.cohort, cost, self.budget_config.get("cohort_usd")):
+                return False
+            self.reserved += cost
+            return True
+
+    def plan(self, llm_configuration, llm_configurations, input_tokens, min_output_tokens, needs_images=False):
+        # plan_call under what is left, with the planned call's worst-case cost reserved; (None, None) if none fits
+        configuration, name = plan_call(llm_configuration, llm_configurations, input_tokens, self.remaining(),
+                                        min_output_tokens, needs_images)
+        if configuration is None or not self.reserve(worst_case_cost(configuration, input_tokens)):
+            return None, None
+        return configuration, name
+
+    def settle(self, reserved, cost):
+        with self._lock:
+            self.reserved -= reserved
+            self.spent += cost
+        self.ledger.add(self.cohort, cost - reserved)
+
+    def add(self, cost):
+        # Spend of a call that reserved nothing
+        with self._lock:
+            self.spent += cost
+        self.ledger.add(self.cohort, cost)
+
+
+def resolve_cohort(budget_config, code):
+    # The cohort a ?cohort= code stands for; a missing or unknown code is "default"
+    return budget_config.get("cohorts", {}).get(code, "default") if code else "default"
+
+
+def remaining_budget(budget_config, session_spent, cohort_spent):
+    # USD left under the tighter of the two ceilings; None when neither is set
+    limits = []
+    if budget_config.get("session_usd") is not None:
+        limits.append(budget_config["session_usd"] - session_spent)
+    if budget_config.get("cohort_usd") is not None:
+        limits.append(budget_config["cohort_usd"] - cohort_spent)
+    return min(limits) if limits else None
+
+
+def estimate_input_tokens(system_prompt, chat_history, user_prompt):
+    return estimate_tokens(system_prompt) + history_tokens(chat_history) + estimate_tokens(user_prompt)
+
+
+def worst_case_cost(llm_configuration, input_tokens):
+    # What a call costs at most: the estimated prompt and all of max_tokens as output
+    return completion_cost(llm_configuration, {"input_tokens": input_tokens,
+                                               "output_tokens": llm_configuration.get("max_tokens", 1000)})
+
+
+def affordable_output_tokens(llm_configuration, input_tokens, remaining):
+    # Most output tokens the remaining budget pays for once the prompt is paid for
+    left = remaining - completion_cost(llm_configuration, {"input_tokens": input_tokens})
+    price_output = llm_configuration["price_output_token_1M"] / 1000000
+    if left <= 0:
+        return 0
+    if price_output <= 0:
+        return llm_configuration.get("max_tokens", 1000)
+    return int(left / price_output)
+
+
+def plan_call(llm_configuration, llm_configurations, input_tokens, remaining, min_output_tokens, needs_images=False):
+    # The configuration to call with, max_tokens clamped to what the remaining budget pays for. When that is under
+    # min_output_tokens, moves to the cheaper models in llm_configurations, the least cheap first. Returns
+    # (configuration, name in llm_configurations or None when it is the given one), or (None, None) if none fits.
+    if remaining is None:
+        return llm_configuration, None
+
+    def estimated_cost(configuration):
+        return completion_cost(configuration, {"input_tokens": input_tokens, "output_tokens": min_output_tokens})
+
+    current_cost = estimated_cost(llm_configuration)
+    cheaper = sorted(((estimated_cost(configuration), name) for name, configuration in llm_configurations.items()
+                      if estimated_cost(configuration) < current_cost
+                      and (configuration.get("supports_images", False) or not needs_images)), reverse=True)
+    candidates = [(None, llm_configuration)] + [(name, llm_configurations[name]) for _, name in cheaper]
+    for name, configuration in candidates:
+        max_tokens = configuration.get("max_tokens", 1000)
+        output_tokens = min(max_tokens, affordable_output_tokens(configuration, input_tokens, remaining))
+        if output_tokens >= min(min_output_tokens, max_tokens):
+            return dict(configuration, max_tokens=output_tokens), name
+    return None, None
@@ -0,0 +1,180 @@
+import functools
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+
+# Columns indexed for lookups and stratified sampling. Each one also gets a <column>_rank
+# (1..n within its value), so a random case from any stratum is a single indexed lookup.
+INDEX_COLUMNS = ("specialty", "initial_diagnosis", "answer")
+
+
+def default_index_path(path):
+    return path + ".index.sqlite3"
+
+
+def index_is_current(path, index_path):
+    if not os.path.exists(index_path):
+        return False
+    source = os.stat(path)
+    try:
+        with sqlite3.connect(f"file:{index_path}?mode=ro", uri=True) as conn:
+            meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+    except sqlite3.Error:
+        return False
+    return meta.get("source_size") == str(source.st_size) and meta.get("source_mtime") == str(source.st_mtime_ns)
+
+
+def build_index(path, index_path=None):
+    # Streams the JSONL once and records the byte offset of every case; written to a temporary
+    # file and swapped in, so workers that start at the same time never read a half-built index
+    index_path = index_path or default_index_path(path)
+    source = os.stat(path)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    rank_columns = ", ".join(f"{column}_rank INTEGER NOT NULL" for column in INDEX_COLUMNS)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute(
+        "CREATE TABLE cases (position INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, "
+        "specialty TEXT, initial_diagnosis TEXT, answer TEXT, "
+        f"offset INTEGER NOT NULL, length INTEGER NOT NULL, {rank_columns})"
+    )
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def rows():
+        counts = {column: {} for column in INDEX_COLUMNS}
+        position = 0
+        offset = 0
+        with open(path, "rb") as cases_file:
+            for line in cases_file:
+                if line.strip():
+                    case = json.loads(line)
+                    position += 1
+                    values = [case.get(column, "") for column in INDEX_COLUMNS]
+                    ranks = []
+                    for column, value in zip(INDEX_COLUMNS, values):
+                        counts[column][value] = counts[column].get(value, 0) + 1
+                        ranks.append(counts[column][value])
+                    yield (position, case["id"], *values, offset, len(line), *ranks)
+                offset += len(line)
+
+    placeholders = ", ".join("?" * (5 + 2 + len(INDEX_COLUMNS)))
+    conn.executemany(f"INSERT INTO cases VALUES ({placeholders})", rows())
+    for column in INDEX_COLUMNS:
+        conn.execute(f"CREATE INDEX cases_{column} ON cases ({column}, {column}_rank)")
+    conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+        ("source_size", str(source.st_size)),
+        ("source_mtime", str(source.st_mtime_ns)),
+    ])
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+class CaseBank(Mapping):
+    # Read-only mapping of case id -> case dict over a JSONL file. Only the index is opened up front;
+    # cases are read from disk on first use and the most recently used ones are kept in memory.
+
+    def __init__(self, path, index_path=None, cache_size=256):
+        self.path = path
+        self.index_path = index_path or default_index_path(path)
+        self.cache_size = cache_size
+        if not index_is_current(self.path, self.index_path):
+            build_index(self.path, self.index_path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True, check_same_thread=False)
+        self._file = open(self.path, "rb")
+        self._cache = OrderedDict()
+        self._strata = {}
+        self._len = self._query_one("SELECT count(*) FROM cases")[0]
+
+    def _query_one(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def __getitem__(self, case_id):
+        with self._lock:
+            if case_id in self._cache:
+                self._cache.move_to_end(case_id)
+                return self._cache[case_id]
+            row = self._conn.execute("SELECT offset, length FROM cases WHERE id = ?", (case_id,)).fetchone()
+            if row is None:
+                raise KeyError(case_id)
+            self._file.seek(row[0])
+            case = json.loads(self._file.read(row[1]))
+            self._cache[case_id] = case
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return case
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        with self._lock:
+            case_ids = [row[0] for row in self._conn.execute("SELECT id FROM cases ORDER BY position")]
+        return iter(case_ids)
+
+    def scan(self):
+        # Every case in file order, read sequentially and without going through the cache (e.g. to build
+        # a search index over the whole bank)
+        with open(self.path, "rb") as cases_file:
+            for line in cases_file:
+                if line.strip():
+                    yield json.loads(line)
+
+    def random_id(self, rng=random):
+        position = rng.randint(1, self._len)
+        return self._query_one("SELECT id FROM cases WHERE position = ?", (position,))[0]
+
+    def strata(self, column):
+        # {value: number of cases}, read from the index once per column
+        if column not in INDEX_COLUMNS:
+            raise ValueError(f"Cannot stratify on {column}, expected one of {INDEX_COLUMNS}")
+        if column not in self._strata:
+            with self._lock:
+                self._strata[column] = dict(self._conn.execute(
+                    f"SELECT {column}, max({column}_rank) FROM cases GROUP BY {column}").fetchall())
+        return self._strata[column]
+
+    def sample(self, stratify_by=None, value=None, rng=random):
+        # Without stratify_by every case is equally likely; with it every stratum is equally likely,
+        # unless value pins the stratum
+        if stratify_by is None:
+            return self.random_id(rng)
+        strata = self.strata(stratify_by)
+        if value is None:
+            value = rng.choice(sorted(strata))
+        rank = rng.randint(1, strata[value])
+        return self._query_one(f"SELECT id FROM cases WHERE {stratify_by} = ? AND {stratify_by}_rank = ?",
+                               (value, rank))[0]
+
+    def find(self, **filters):
+        unknown = [column for column in filters if column not in INDEX_COLUMNS]
+        if unknown:
+            raise ValueError(f"Cannot filter on {', '.join(unknown)}, expected one of {INDEX_COLUMNS}")
+        where = " AND ".join(f"{column} = ?" for column in filters) or "1"
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                f"SELECT id FROM cases WHERE {where} ORDER BY position", tuple(filters.values()))]
+
+
+@functools.lru_cache(maxsize=None)
+def open_case_bank(path, index_path=None, cache_size=256):
+    return CaseBank(path, index_path, cache_size)
+
+
+if __name__ == "__main__":
+    # python case_bank.py cases/cases.jsonl  - (re)build the index and print the strata
+    bank_path = sys.argv[1]
+    build_index(bank_path)
+    bank = CaseBank(bank_path)
+    print(f"{len(bank)} cases indexed in {bank.index_path}")
+    for index_column in INDEX_COLUMNS:
+        print(f"{index_column}: {bank.strata(index_column)}")
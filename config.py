@@ -1,5 +1,7 @@
-import random
-import streamlit as st
+import functools
+import os
+from case_bank import open_case_bank
+from expert_content import format_expert_content
 
 APP_TITLE = "Modified Script Concordance Test (mSCT) Tutor"
 APP_INTRO = """This is an AI tutor that presents interactive medical case studies with diagnosis and treatment scenarios. 
@@ -32,239 +34,168 @@ HTML_BUTTON = {
 }
 
 SCORING_DEBUG_MODE = True
+# Chat history transcript in the sidebar. It is only rendered once the student switches it on, and then
+# page_size turns at a time, starting from the latest
+SIDEBAR_HISTORY = {
+    "enabled": True,
+    "page_size": 5
+}
 DISPLAY_COST = True
+# Collapsed panel showing which session state keys changed on each run and the session's memory footprint
+SESSION_DEBUG_PANEL = False
+
+# Render AI responses token by token as they arrive instead of waiting for the full completion
+STREAM_RESPONSES = True
+# Minimum number of seconds between two updates of the response box while streaming
+STREAM_RENDER_INTERVAL = 0.05
+
+# How scored phases get feedback and a rubric score:
+# "sequential"  - feedback first, then a second call scoring that feedback
+# "parallel"    - feedback and scoring of the student's answer run at the same time
+# "single_call" - one JSON mode call returning both the feedback and the rubric scores
+SCORING_MODE = "parallel"
+
+# How hard coded responses (phases with "ai_response": False) are shown:
+# "instant" in one update, "chunked" one word or sentence ("unit") per frame at "frame_rate" frames per second,
+# or "write_stream" to let st.write_stream render the same frames. See benchmarks/bench_reveal.py
+CUSTOM_RESPONSE_REVEAL = {
+    "mode": "chunked",
+    "unit": "word",
+    "frame_rate": 30
+}
 
 COMPLETION_MESSAGE = "You've reached the end! I hope you learned something!"
 COMPLETION_CELEBRATION = False
 
 SYSTEM_PROMPT = """You create accurate script concordance tests and walk student through them. """
 
-DISEASE_GENERATOR = {
-    "1_1": {
-        "initial_diagnosis": "Chronic Asthma",
-        "case": """Your next appointment is with a 79-year-old man who is being evaluated for cough. He has a
-history of cough for 6 months and you auscultate a grade 4/6 left apical systolic murmur during
-the exam.
-
-If you were initially thinking of the following diagnosis: Chronic asthma,
-
-And then you determine the following from the patient&#39;s history: He has normal lung
-function tests (FEV1/FVC and FVC).""",
-        "answer": "The diagnosis becomes less likely (-1).",
-        "justification": "Normal lung function is possible in chronic asthma, but unlikely in an elderly chronic asthmatic."
-    },
-    "1_2": {
-        "initial_diagnosis": "COPD",
-        "case": """Your next appointment is with a 79-year-old man who is being evaluated for cough. He has a
-history of cough for 6 months, and you auscultate a grade 4/6 left apical systolic murmur during
-the exam.
-
-If you were initially thinking of the following diagnosis: COPD,
-
-And then you determine the following from the patient&#39;s history: The cough occurs
-during forced exhalation and is accompanied by wheezing due to dynamic airway
-collapse.""",
-        "answer": "The diagnosis becomes more likely (+1).",
-        "justification": "COPD is characterized by chronic bronchitis and emphysema, which can present with a cough, especially during forced exhalation, and wheezing due to airway collapse. Note that dynamic airway collapse is not a measure used for diagnosis."
-    },
-    "1_3": {
-        "initial_diagnosis": "Pulmonary Edema",
-        "case": """Your next appointment is with a 79-year-old man who is being evaluated for cough. He has a
-history of cough for 6 months and you auscultate a grade 4/6 left apical systolic murmur during
-the exam.
-
-If you were initially thinking of the following diagnosis- Pulmonary edema (left-sided
-congestive heart failure CHF),
-
-And then you determine the following from the patient&#39;s history: The cough has become
-more frequent in the past 48 hours.""",
-        "answer": "The diagnosis becomes neither more nor less likely (0).",
-        "justification": "Many things can cause an acute worsening of a chronic symptom, e.g., viral infection. While an increase in the frequency of the cough could be indicative of worsening heart failure, it is not specific enough to significantly alter the likelihood of pulmonary edema without additional supporting symptoms or findings such as dyspnea, orthopnea, or paroxysmal nocturnal dyspnea."
-    },
-    "2_1": {
-        "initial_diagnosis": "Pulmonary Edema",
-        "case": """Your next appointment is with a 60-year-old woman who is being evaluated for cough. She
-has had a cough for 8 months, and you auscultate a grade 4/6 left apical systolic murmur during
-the exam.
-
-If you were initially thinking of the following diagnosis: Pulmonary edema (left sided
-congestive heart failure),
-
-And then you determine the following from the patient&#39;s physical exam: Her heart rate is
-70 beats/min, and thoracic auscultation reveals crackles bilaterally.""",
-        "answer": "The diagnosis becomes more likely (+1).",
-        "justification": "Diagnosis is reasonable given the age and duration of symptoms. The presence of crackles supports the diagnosis of pulmonary edema secondary to left-sided congestive heart failure."
-    },
-    "2_2": {
-        "initial_diagnosis": "COPD",
-        "case": """Your next appointment is with a 60-year-old woman who is being evaluated for cough. She
-has a history of cough for 8 months and you auscultate a grade 4/6 left apical systolic murmur
-during the exam.
-
-If you were initially thinking of the following diagnosis- COPD,
-
-And then you determine the following from the patient&#39;s physical exam: The patient is a
-smoker, the cough occurs in the morning, and lung auscultation reveals crackles
-bilaterally.""",
-        "answer": "The diagnosis becomes neither more nor less likely (0).",
-        "justification": "Smoking history and morning cough are consistent with COPD, but the presence of bilateral crackles is more suggestive of chronic heart failure."
-    },
-    "2_3": {
-        "initial_diagnosis": "Pulmonary Edema",
-        "case": """Your next appointment is with a 60-year-old woman who is being evaluated for cough. She
-has a history of cough for 8 months and you auscultate a grade 4/6 left apical systolic murmur
-during the exam.
-
-If you were initially thinking of the following diagnosis: Pulmonary edema (left-sided
-congestive heart failure),
-
-And then you determine the following from the patient&#39;s physical exam: Her heart rate is
-120 beats/min, and her respiratory rate is 10 breaths/min.""",
-        "answer": "The diagnosis becomes neither more nor less likely (0).",
-        "justification": "As a note, if HR is 120, it’s extremely unlikely the respiratory rate is 10, and there is likely an error in the exam. Both findings are contradictory to each other to support the initial diagnosis, and further information or redoing the exam is needed."
-    },
-    "3_1": {
-        "initial_diagnosis": "Chronic bronchitis",
-        "case": """You are presented with a 52-year-old man who is being evaluated for a cough that he has had
-for 7 months. He describes the cough as harsh and occurs with activity. On examination, he is
-bright and alert. His mucous membranes are pink and moist with a normal capillary refill time.
-His heart rate is 70 beats/min and femoral pulses are strong bilaterally. His respiratory rate is 14
-breaths/min. A grade 4/6 left apical systolic murmur was auscultated.
-
-If you were initially thinking of the following diagnosis: Chronic bronchitis,
-
-And then you determine the following from the patient&#39;s physical exam: When
-auscultating the lung fields, crackles are heard bilaterally.""",
-        "answer": "The diagnosis becomes less likely (-1).",
-        "justification": "The presence of bilateral crackles suggests lung disease, but there is a disconnect with his cough, and there is a lack of detail e.g. productive, and shortness of breath."
-    },
-    "3_2": {
-        "initial_diagnosis": "Pulmonary Edema",
-        "case": """You are presented with a 52-year-old man who is being evaluated for a cough that he has had
-for 7 months. He describes the cough as harsh and occurs with activity. On examination, he is
-bright and alert. His mucous membranes are pink and moist with a normal capillary refill time.
-His heart rate is 70 beats/min and femoral pulses are strong bilaterally. His respiratory rate is 14
-breaths/min. A grade 4/6 left apical systolic murmur was auscultated.
-
-If you were initially thinking of the following diagnosis: Pulmonary edema (left-sided
-congestive heart failure),
-
-And then you determine the following from the patient&#39;s physical exam: When
-auscultating the lung fields, crackles are heard bilaterally.""",
-        "answer": "The diagnosis becomes neither more nor less likely (0).",
-        "justification": "Bilateral crackles are consistent with pulmonary edema but can also be present in other conditions such as interstitial lung disease or pneumonia. Their presence alone does not confirm or rule out the diagnosis of pulmonary edema."
-    },
-    "4_1": {
-        "initial_diagnosis": "Innocent Murmur",
-        "case": """Your next appointment is with a 4-month-old girl for her well-child exam. She has a history
-of an occasional cough for the past few days. Her appetite and activity level are normal
-
-according to her parents. On physical examination, she is bright and alert with pink mucus
-membranes, and is normal size for her age. You auscultate a murmur during the exam.
-
-If you were initially thinking of the following diagnosis: Innocent murmur,
+# mSCT cases live in a JSONL case bank (one case per line: id, specialty, initial_diagnosis, case, answer,
+# justification). An SQLite index next to it is rebuilt whenever the file changes, and cases are only read
+# from disk when used, so DISEASE_GENERATOR[case_id] stays cheap however large the bank gets.
+CASE_BANK = {
+    "path": os.path.join(os.path.dirname(os.path.abspath(__file__)), "cases", "cases.jsonl"),
+    "cache_size": 256
+}
 
-And then you determine the following from the patient&#39;s physical exam: The murmur is a
-grade 2/6 that is systolic and heard best at the left base.""",
-        "answer": "The diagnosis becomes less likely (-1).",
-        "justification": "2/6 is pretty loud for something innocent. In the absence of delayed motor milestones, or abnormal exam finding, I do not believe the cough is related to the incidental finding of a 2/6 murmur."
-    },
-    "4_2": {
-        "initial_diagnosis": "Patent ductus arteriosus",
-        "case": """Your next appointment is with a 4-month-old girl for her well-child exam. She has a history
-of an occasional cough for the past few days. Her appetite and activity level are normal
-according to her parents. On physical examination, she is bright and alert with pink mucus
-membranes, and is normal size for her age. You auscultate a murmur during the exam.
-
-If you were initially thinking of the following diagnosis: Patent ductus arteriosus,
-
-And then you determine the following from the patient&#39;s physical exam: The murmur is a
-palpable grade 5/6. It is loudest at the left upper sternal border and is continuous,
-occurring throughout systole and diastole.""",
-        "answer": "The diagnosis becomes more likely (+1).",
-        "justification": "The murmur is loud (grade 5/6), continuous, and location is consistent with patent ductus arteriosus (PDA)."
-    }
+DISEASE_GENERATOR = open_case_bank(CASE_BANK["path"], cache_size=CASE_BANK["cache_size"])
 
+# Cases are assigned once per session (see main.py); PHASES is built from that case the first time it is
+# needed and memoized, so prompts stay identical across reruns and between sessions on the same case
+CASE_SELECTION = {
+    # None samples uniformly over all cases, or one of case_bank.INDEX_COLUMNS to give each stratum equal weight
+    "stratify_by": None
 }
 
-if "random_key" in st.session_state:
-    random_key = st.session_state["random_key"]
-else:
-    # Select a random key from the DISEASE_GENERATOR dictionary
-    random_key = random.choice(list(DISEASE_GENERATOR.keys()))
-
-PHASES = {
-    "about": {
-        "name": "Choose a Disease",
-        "fields": {
-            "disease": {
-                "type": "markdown",
-                "body": """To begin, the system will select a case for you to practice on.""",
-                "unsafe_allow_html": True
-            }
 
+# How the rationale prompt asks for the case-only sections when a case has no precomputed expert_content
+EXPERT_SECTIONS_PROMPT = """       You will then generate a percentage estimated probability for the diagnosis, diagnostic testing, or treatment based on the information given. 
+       For example: '**Probability** \n\nEstimated probability: 75%. Please note that this percentage is an educational guess and should not replace clinical judgment or professional diagnostic procedures.'
+       Next, you generate a justification expected from typical expert responses. 
+       For example: '**Expert Justification**\n\nThe presence of recurrent yeast infections in the patients history is more indicative of diabetes rather than hypothyroidism. Diabetes can lead to elevated blood sugar levels, creating a favorable environment for yeast overgrowth. In contrast, yeast infections are not typically associated with hypothyroidism. Therefore, the new information increases the likelihood of the initial diagnosis of diabetes.'"""
+
+
+def expert_sections_prompt(case):
+    expert_content = case.get("expert_content")
+    if not expert_content:
+        return EXPERT_SECTIONS_PROMPT
+    # Precomputed by expert_content.py and shown above the reply (the phase's response_prefix), so the model
+    # only writes the student-specific Diagnosis and Feedback
+    return ("       The estimated probability and the expert justification below are already shown to the user "
+            "right above your reply. Do not repeat them, start with the Diagnosis.\n"
+            f"       Estimated probability: {expert_content['probability']}\n"
+            f"       Expert Justification: {expert_content['justification']}")
+
+
+@functools.lru_cache(maxsize=CASE_BANK["cache_size"])
+def build_phases(case_id):
+    case = DISEASE_GENERATOR[case_id]
+    return {
+        "about": {
+            "name": "Choose a Disease",
+            "fields": {
+                "disease": {
+                    "type": "markdown",
+                    "body": """To begin, the system will select a case for you to practice on.""",
+                    "unsafe_allow_html": True
+                }
+
+            },
+            "user_prompt": "Please generate a case study for me to practice the Script Concordance Test exam",
+            "ai_response": False,
+            "custom_response": case["case"],
+            "allow_skip": False,
+            "button_label": "Begin"
         },
-        "user_prompt": "Please generate a case study for me to practice the Script Concordance Test exam",
-        "ai_response": False,
-        "custom_response": DISEASE_GENERATOR[random_key]["case"],
-        "allow_skip": False,
-        "button_label": "Begin"
-    },
-    "likert": {
-        "name": "Score on the Likert Scale",
-        "fields": {
-            "likert": {
-                "type": "selectbox",
-                "options": ['+1 More likely', '0 Neither more nor less likely', '-1 Less likely'],
-                "label": """Would the new information make your decision:""",   
-                "index": 1
-            }
-        },
-        "phase_instructions": "The user reacts to the second statement you provided with a likert scale rating indicating if they are more or less likely to stick with the original diagnosis. Simply acknowledge their rating (do not provide feedback at this point) and then ask them to provide written justification for their chosen Likert ranking.",
-        "user_prompt": "{likert}",
-        "ai_response": False,
-        "custom_response": "Thank you for your rating! Now, please provide a written justification for your rating.",
-        "scored_phase": False,
-        "allow_revisions": False,
-        "max_revisions": 2,
-        "allow_skip": True,
-        "show_prompt": False,
-        "read_only_prompt": False
-    },
-    "rationale": {
-        "name": "Explain your Rationale",
-        "fields": {
-            "rationale": {
-                "type": "text_area",
-                "height": 200,
-                "label": "Please provide written justification for your chosen Likert ranking.",
-            }
+        "likert": {
+            "name": "Score on the Likert Scale",
+            "fields": {
+                "likert": {
+                    "type": "selectbox",
+                    "options": ['+1 More likely', '0 Neither more nor less likely', '-1 Less likely'],
+                    "label": """Would the new information make your decision:""",   
+                    "index": 1
+                }
+            },
+            "phase_instructions": "The user reacts to the second statement you provided with a likert scale rating indicating if they are more or less likely to stick with the original diagnosis. Simply acknowledge their rating (do not provide feedback at this point) and then ask them to provide written justification for their chosen Likert ranking.",
+            "user_prompt": "{likert}",
+            "ai_response": False,
+            "custom_response": "Thank you for your rating! Now, please provide a written justification for your rating.",
+            "scored_phase": False,
+            "allow_revisions": False,
+            "max_revisions": 2,
+            "allow_skip": True,
+            "show_prompt": False,
+            "read_only_prompt": False
         },
-        "phase_instructions": f"""
+        "rationale": {
+            "name": "Explain your Rationale",
+            "fields": {
+                "rationale": {
+                    "type": "text_area",
+                    "height": 200,
+                    "label": "Please provide written justification for your chosen Likert ranking.",
+                }
+            },
+            "phase_instructions": f"""
        The user will provide a written rationale for their ranking. 
        They should explain their thought process, how they used the key features or information to make their decision and provide a defense for their answer using background knowledge. 
 
-       You will then generate a percentage estimated probability for the diagnosis, diagnostic testing, or treatment based on the information given. 
-       For example: '**Probability** \n\nEstimated probability: 75%. Please note that this percentage is an educational guess and should not replace clinical judgment or professional diagnostic procedures.'
-       Next, you generate a justification expected from typical expert responses. 
-       For example: '**Expert Justification**\n\nThe presence of recurrent yeast infections in the patients history is more indicative of diabetes rather than hypothyroidism. Diabetes can lead to elevated blood sugar levels, creating a favorable environment for yeast overgrowth. In contrast, yeast infections are not typically associated with hypothyroidism. Therefore, the new information increases the likelihood of the initial diagnosis of diabetes.'
-       Then, you determine if the user's answer matched the correct answer of {DISEASE_GENERATOR[random_key]["answer"]}. If it does not match, provide an explanation for what might have led the student to the wrong answer and a recommendation on how to avoid that mistake in the future. 
+{expert_sections_prompt(case)}
+       Then, you determine if the user's answer matched the correct answer given below. If it does not match, provide an explanation for what might have led the student to the wrong answer and a recommendation on how to avoid that mistake in the future. 
        For example: '**Diagnosis**\n\nYour answer of [user answer e.g. -1, 0, +1] did not match my expected answer. Remember that strep throat is a bacterial infection, so viral indicators may not increase the likelihood of strep throat'
        Then, you compare the correct justification to that entered by the user, offering feedback comparing their choices to the correct justification, and suggesting areas for improvement or affirmation. 
        For example: '**Feedback**\n\nIt’s commendable that you identified the complexity introduced by the additional cardiac symptoms and did not solely fixate on the respiratory symptoms, which could lead to a narrow differential diagnosis. Going forward, continue to consider the entire clinical picture and how various symptoms can interconnect. This holistic approach will enhance your diagnostic accuracy.'
-        Correct Justification: {DISEASE_GENERATOR[random_key]["justification"]}
+        Correct Answer: {case["answer"]}
+        Correct Justification: {case["justification"]}
         """,
-        "user_prompt": "{rationale}",
-        "ai_response": True,
-        "scored_phase": False,
-        "allow_revisions": True,
-        "max_revisions": 2,
-        "allow_skip": True,
-        "show_prompt": False,
-        "read_only_prompt": False
-    }
+            "user_prompt": "{rationale}",
+            # Not scored in the app (scored_phase is False); batch.py grades each rationale with it
+            "rubric": f"""
+        1. Rating
+            1 point - The user's Likert rating matches the correct answer: {case["answer"]}
+            0 points - It does not
+        2. Key finding
+            1 point - The rationale names the finding in the new information that changes the likelihood of the initial diagnosis
+            0 points - It does not
+        3. Reasoning
+            2 points - The rationale explains why that finding makes the diagnosis more likely, less likely or neither, in line with the correct justification: {case["justification"]}
+            1 point - The explanation is partly correct or incomplete
+            0 points - There is no explanation, or it contradicts the correct justification
+        Total: 4 points
+        """,
+            "response_prefix": format_expert_content(case["expert_content"]) if case.get("expert_content") else "",
+            # Checked locally before the LLM, see PREGRADE; "likert_key" is the session state key of the rating
+            "pregrade": {"field": "rationale", "likert_key": "likert_likert_user_input"},
+            "ai_response": True,
+            "scored_phase": False,
+            "allow_revisions": True,
+            "max_revisions": 2,
+            "allow_skip": True,
+            "show_prompt": False,
+            "read_only_prompt": False
+        }
 
-}
+    }
 
 def prompt_conditionals(prompt, user_input, phase_name=None):
     #TO-DO: This is a hacky way to make prompts conditional that requires the user to know a lot of python and get the phase and field names exactly right. Future task to improve it. 
@@ -277,8 +208,23 @@ def prompt_conditionals(prompt, user_input, phase_name=None):
 selected_llm = "gpt-3.5-turbo"
 
 
+# "provider" picks the adapter in llm_adapters.ADAPTERS ("openai", "gemini" or "anthropic")
+# "context_budget_tokens" caps the estimated input tokens (system prompt, history and user prompt) per call;
+# older chat history turns are trimmed or summarized to stay under it, see CONTEXT_WINDOW
+# "prompt_caching" marks the system prompt (and the chat history) as cacheable on Anthropic models; OpenAI caches
+# prompts over 1024 tokens automatically. Cached input is billed at "price_cached_input_token_1M" and, on Anthropic,
+# writing the cache at "price_cache_write_token_1M" (both default to the regular input price)
+# "rpm_limit" and "tpm_limit" are the account's requests and tokens per minute for the model; every session in the
+# process shares them, see RATE_LIMITS. Leave them out to not throttle a model
+# "routing" maps a phase name (or "default") to a policy: "fallback" lists LLM_CONFIGURATIONS keys tried in order
+# when the model fails; "hedge" starts the same request on hedge["model"] when the model has not answered
+# (first token, or the full response when not streaming) within the "quantile" of its recent latencies, clamped
+# to min_delay_ms..max_delay_ms (delay_ms until min_samples calls were seen). The first answer wins, the other
+# request is cancelled. Scored phases should not hedge to a different model, so grading stays consistent
 LLM_CONFIGURATIONS = {
     "gpt-4-turbo": {
+        "provider": "openai",
+        "supports_images": True,
         "model": "gpt-4-turbo",
         "frequency_penalty": 0,
         "max_tokens": 1000,
@@ -286,9 +232,13 @@ LLM_CONFIGURATIONS = {
         "temperature": 1,
         "top_p": 1,
         "price_input_token_1M":10,
-        "price_output_token_1M":30
+        "price_output_token_1M":30,
+        "context_budget_tokens": 8000,
+        "rpm_limit": 500,
+        "tpm_limit": 30000
     },
     "gpt-3.5-turbo": {
+        "provider": "openai",
         "model": "gpt-3.5-turbo-0125",
         "frequency_penalty": 0,
         "max_tokens": 1000,
@@ -296,9 +246,24 @@ LLM_CONFIGURATIONS = {
         "temperature": 1,
         "top_p": 1,
         "price_input_token_1M":0.50,
-        "price_output_token_1M":1.50
+        "price_output_token_1M":1.50,
+        "context_budget_tokens": 4000,
+        "rpm_limit": 3500,
+        "tpm_limit": 200000,
+        "routing": {
+            "default": {
+                "fallback": ["claude-haiku", "gemini-1.5-flash"],
+                "hedge": {"model": "gemini-1.5-flash", "quantile": 0.95, "delay_ms": 2000, "min_delay_ms": 500,
+                          "max_delay_ms": 8000, "min_samples": 20}
+            },
+            "rationale": {
+                "fallback": ["claude-haiku"]
+            }
+        }
     },
     "gpt-4o": {
+        "provider": "openai",
+        "supports_images": True,
         "model": "gpt-4o",
         "frequency_penalty": 0,
         "max_tokens": 250,
@@ -306,58 +271,227 @@ LLM_CONFIGURATIONS = {
         "temperature": 1,
         "top_p": 1,
         "price_input_token_1M":5,
-        "price_output_token_1M":15
+        "price_cached_input_token_1M":2.5,
+        "price_output_token_1M":15,
+        "context_budget_tokens": 8000,
+        "rpm_limit": 500,
+        "tpm_limit": 30000,
+        "routing": {
+            "default": {
+                "fallback": ["claude-3.5-sonnet", "gemini-1.5-pro"],
+                "hedge": {"model": "gpt-3.5-turbo", "quantile": 0.95, "delay_ms": 3000, "min_delay_ms": 1000,
+                          "max_delay_ms": 10000, "min_samples": 20}
+            },
+            "rationale": {
+                "fallback": ["claude-3.5-sonnet", "gemini-1.5-pro"]
+            }
+        }
     },
     "gemini-1.0-pro": {
+        "provider": "gemini",
         "model": "gemini-1.0-pro",
         "temperature": 1,
         "top_p": 0.95,
         "max_tokens": 1000,
         "price_input_token_1M":.5,
-        "price_output_token_1M":1.5
+        "price_output_token_1M":1.5,
+        "context_budget_tokens": 8000,
+        "rpm_limit": 360,
+        "tpm_limit": 120000
     },
     "gemini-1.5-flash": {
+        "provider": "gemini",
         "model": "gemini-1.5-flash",
         "temperature": 1,
         "top_p": 0.95,
         "max_tokens": 1000,
         "price_input_token_1M":.35,
-        "price_output_token_1M":1.05
+        "price_output_token_1M":1.05,
+        "context_budget_tokens": 8000,
+        "rpm_limit": 1000,
+        "tpm_limit": 1000000
     },
     "gemini-1.5-pro": {
+        "provider": "gemini",
         "model": "gemini-1.5-pro",
         "temperature": 1,
         "top_p": 0.95,
         "max_tokens": 1000,
         "price_input_token_1M":3.5,
-        "price_output_token_1M":10.50
+        "price_output_token_1M":10.50,
+        "context_budget_tokens": 8000,
+        "rpm_limit": 360,
+        "tpm_limit": 2000000
     },
     "claude-3.5-sonnet": {
+        "provider": "anthropic",
         "model": "claude-3-5-sonnet-20240620",
         "max_tokens": 1000,
         "temperature": 1,
+        "prompt_caching": True,
         "price_input_token_1M": 3,
-        "price_output_token_1M": 15
+        "price_cached_input_token_1M": 0.30,
+        "price_cache_write_token_1M": 3.75,
+        "price_output_token_1M": 15,
+        "context_budget_tokens": 8000,
+        "rpm_limit": 50,
+        "tpm_limit": 40000
     },
     "claude-opus": {
+        "provider": "anthropic",
         "model": "claude-3-opus-20240229",
         "max_tokens": 1000,
         "temperature": 1,
+        "prompt_caching": True,
         "price_input_token_1M": 15,
-        "price_output_token_1M": 75
+        "price_cached_input_token_1M": 1.50,
+        "price_cache_write_token_1M": 18.75,
+        "price_output_token_1M": 75,
+        "context_budget_tokens": 8000,
+        "rpm_limit": 50,
+        "tpm_limit": 20000
     },
     "claude-sonnet": {
+        "provider": "anthropic",
         "model": "claude-3-sonnet-20240229",
         "max_tokens": 1000,
         "temperature": 1,
         "price_input_token_1M": 3,
-        "price_output_token_1M": 15
+        "price_output_token_1M": 15,
+        "context_budget_tokens": 8000,
+        "rpm_limit": 50,
+        "tpm_limit": 40000
     },
     "claude-haiku": {
+        "provider": "anthropic",
         "model": "claude-3-haiku-20240307",
         "max_tokens": 1000,
         "temperature": 1,
+        "prompt_caching": True,
         "price_input_token_1M": 0.25,
-        "price_output_token_1M": 1.25
+        "price_cached_input_token_1M": 0.03,
+        "price_cache_write_token_1M": 0.30,
+        "price_output_token_1M": 1.25,
+        "context_budget_tokens": 8000,
+        "rpm_limit": 50,
+        "tpm_limit": 50000
     }
 }
+
+# How chat history over the model's context_budget_tokens is reduced:
+# "trim" drops the oldest turns, "summarize" replaces them with a short summary made by the same model
+CONTEXT_WINDOW = {
+    "strategy": "trim",
+    "summary_max_tokens": 300,
+    "summary_prompt": "Summarize the following tutoring conversation between a student and an AI tutor in a few sentences. Keep the case details, the student's answers and the key feedback they received."
+}
+
+# Provider clients are created once per process and shared by all sessions.
+# Settings are merged in order: "default", then the provider ("openai", "anthropic", "gemini"),
+# then the model name (e.g. "gpt-4o"), so any provider or model can get its own pool.
+# "base_url" points a provider at another endpoint, e.g. benchmarks/fake_llm_server.py (Gemini needs
+# "transport": "rest" for that).
+CLIENT_POOL = {
+    "default": {
+        "max_connections": 200,
+        "max_keepalive_connections": 50,
+        "keepalive_expiry": 60,
+        "timeout": 60,
+        # Retries are done by rate_limit.RateLimitedAdapter, see RATE_LIMITS
+        "max_retries": 0
+    },
+    "openai": {},
+    "anthropic": {},
+    "gemini": {
+        "transport": "grpc"
+    }
+}
+
+DISPLAY_CLIENT_POOL_STATS = False
+
+# Calls that fail with 429, 5xx, timeouts or connection errors are retried up to max_retries times, waiting
+# a random time up to base_delay * 2^attempt seconds (capped at max_delay) or the provider's Retry-After.
+# A 429 also halves the model's rpm/tpm until successful calls bring it back. After breaker_failure_threshold
+# failed calls in a row the model is not called for breaker_cooldown seconds.
+RATE_LIMITS = {
+    "max_retries": 4,
+    "base_delay": 1,
+    "max_delay": 30,
+    "breaker_failure_threshold": 5,
+    "breaker_cooldown": 30
+}
+
+# Student progress (phase, answers, AI responses, chat history, price) is checkpointed to a store shared by
+# the workers, so a session survives a worker restart and can continue on any worker behind a load balancer.
+# The ?session=<id> query parameter names the session; opening that URL again restores it.
+# "sqlite" shares one file between the workers on a host; "redis" shares between hosts (url "redis://...",
+# or "memory://" for an in-process stand-in while developing). Checkpoints are written in batches every
+# flush_interval seconds, so a worker that crashes loses at most that much progress. Off by default: the store
+# keeps students' answers, AI feedback and chat history for ttl_seconds after their last change (see README.md)
+SESSION_STORE = {
+    "enabled": False,
+    "backend": "sqlite",
+    "path": "sessions.sqlite3",
+    "url": "redis://localhost:6379/0",
+    "ttl_seconds": 7 * 24 * 60 * 60,
+    "flush_interval": 1.0,
+    "max_batch": 500
+}
+
+# Spend ceilings in USD per session and per cohort (None for no ceiling). "cohorts" maps the codes handed out in
+# ?cohort=<code> links to cohort names, e.g. {"x7Kq2m": "md1-fall"}; sessions without a code or with one not
+# listed count against "default", so editing the URL cannot open a fresh allowance. "sqlite" shares a cohort's
+# spend between the workers on a host, "memory" counts per worker (delete budget.sqlite3 to start cohorts over).
+# Before each call the prompt tokens are estimated locally and max_tokens is clamped to what the remaining
+# budget pays for. When that leaves fewer than min_output_tokens, the call moves to the next cheaper model in
+# LLM_CONFIGURATIONS, and is refused when none fits. Routing fallbacks and hedges are clamped the same way, or
+# skipped. Every call reserves its worst-case cost (prompt plus max_tokens) until it ends, so parallel calls
+# cannot overspend, and a hedge that loses the race is still paid for.
+BUDGET = {
+    "enabled": True,
+    "session_usd": 0.25,
+    "cohort_usd": 50.0,
+    "cohorts": {},
+    "min_output_tokens": 150,
+    "backend": "sqlite",
+    "path": "budget.sqlite3"
+}
+
+# Every LLM call is logged as one JSON line (logger "msct.llm") and aggregated per phase, provider and model.
+# With metrics_port set, Prometheus can scrape http://metrics_host:metrics_port/metrics. With several worker
+# processes on one host only the first to bind the port serves it, so give each worker its own port
+TELEMETRY = {
+    "log_calls": True,
+    "metrics_host": "127.0.0.1",
+    "metrics_port": 9464
+}
+
+DISPLAY_LATENCY_STATS = False
+
+# Rationales are first compared locally with the case's reference justification (TF-IDF similarity, see
+# pregrade.py) and the likert rating with the case's answer, giving a verdict and a provisional score in
+# milliseconds. Blank answers (under min_words words) and copies of the case text (restatement_overlap of
+# their word trigrams taken verbatim from it) are sent back to the student without an LLM call.
+# "clear_match" (likert right and similarity >= pass_similarity) and "clear_mismatch" (likert wrong and
+# similarity <= fail_similarity) get templated feedback instead of an LLM call when listed in local_feedback;
+# "ambiguous" ones always go to the LLM.
+PREGRADE = {
+    "enabled": True,
+    "min_words": 4,
+    "restatement_overlap": 0.8,
+    "pass_similarity": 0.35,
+    "fail_similarity": 0.05,
+    "local_feedback": []
+}
+
+# Completion cache in front of every LLM call, keyed on model, sampling parameters, prompts and history.
+# "memory" keeps an LRU per worker process; "sqlite" shares one file between all workers on the host.
+# Responses sampled with temperature > 0 are only cached when allow_nonzero_temperature is True.
+RESPONSE_CACHE = {
+    "enabled": True,
+    "backend": "memory",
+    "path": "response_cache.sqlite3",
+    "max_entries": 1000,
+    "ttl_seconds": 24 * 60 * 60,
+    "allow_nonzero_temperature": False
+}
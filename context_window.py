@@ -0,0 +1,51 @@
+import functools
+import math
+
+CHARS_PER_TOKEN = 4
+
+
+@functools.lru_cache(maxsize=1)
+def get_encoding():
+    # Loaded on the first count rather than at import: on a cold worker tiktoken downloads its vocabulary, which
+    # would hold up the first page. tiktoken is optional (and may be unable to fetch the vocabulary); None falls
+    # back to ~4 characters per token
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def estimate_tokens(text):
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def turn_tokens(turn):
+    return estimate_tokens(turn["user"] or "") + estimate_tokens(turn["assistant"] or "")
+
+
+def history_tokens(chat_history):
+    return sum(turn_tokens(turn) for turn in chat_history)
+
+
+def fit_history(chat_history, available_tokens):
+    # Keep the most recent turns that fit in the budget; returns (kept, dropped), both in chronological order
+    kept_tokens = 0
+    first_kept = len(chat_history)
+    for index in range(len(chat_history) - 1, -1, -1):
+        tokens = turn_tokens(chat_history[index])
+        if kept_tokens + tokens > available_tokens:
+            break
+        kept_tokens += tokens
+        first_kept = index
+    return chat_history[first_kept:], chat_history[:first_kept]
+
+
+def format_transcript(chat_history):
+    return "\n\n".join(f"User: {turn['user']}\nAI: {turn['assistant']}" for turn in chat_history)
@@ -0,0 +1,61 @@
+import sys
+
+import streamlit as st
+
+SNAPSHOT_KEY = "_debug_panel_snapshot"
+
+
+def deep_sizeof(obj, seen=None):
+    # Approximate memory held by a value, following dicts and sequences
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+def session_snapshot(session_state):
+    snapshot = {}
+    for key in list(session_state.keys()):
+        if key == SNAPSHOT_KEY:
+            continue
+        value = session_state[key]
+        snapshot[key] = (deep_sizeof(value), hash(repr(value)))
+    return snapshot
+
+
+def diff_snapshots(previous, current):
+    changes = []
+    for key, (size, fingerprint) in current.items():
+        if key not in previous:
+            changes.append({"key": key, "change": "added", "bytes": size, "delta_bytes": size})
+        elif previous[key][1] != fingerprint:
+            changes.append({"key": key, "change": "changed", "bytes": size, "delta_bytes": size - previous[key][0]})
+    for key in previous.keys() - current.keys():
+        changes.append({"key": key, "change": "removed", "bytes": 0, "delta_bytes": -previous[key][0]})
+    return sorted(changes, key=lambda change: -abs(change["delta_bytes"]))
+
+
+def render_session_debug_panel():
+    # Nothing is measured or sent to the browser until the toggle is switched on
+    with st.expander("Session state debug", expanded=False):
+        if not st.toggle("Inspect session state", key="debug_panel_open"):
+            return
+        current = session_snapshot(st.session_state)
+        previous = st.session_state.get(SNAPSHOT_KEY, {})
+        st.session_state[SNAPSHOT_KEY] = current
+
+        total_bytes = sum(size for size, fingerprint in current.values())
+        st.write("Session state : {} keys, {:.1f} KB".format(len(current), total_bytes / 1024))
+        changes = diff_snapshots(previous, current)
+        if changes:
+            st.write("Changed since the last run:")
+            st.table(changes)
+        else:
+            st.write("No changes since the last run.")
@@ -0,0 +1,105 @@
+# Ahead-of-time generation of the parts of the rationale feedback that depend only on the case: the
+# estimated probability and the expert justification. They are stored on each case in the case bank as
+# "expert_content", and the rationale phase then only asks the model for the student-specific Diagnosis
+# and Feedback sections (see build_phases in config.py).
+#
+#   python -m expert_content cases/cases.jsonl [--model gpt-4o] [--concurrency 4] [--force]
+#
+# Cases that already have expert_content are skipped, so run it again whenever cases are added.
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+EXPERT_CONTENT_PROMPT = """You write reference material for a Script Concordance Test case used to teach medical students.
+Given the case, the correct answer and the correct justification, reply with a JSON object with two keys:
+"probability": an estimated probability (a percentage) for the diagnosis, diagnostic testing, or treatment after the new information, e.g. "75%".
+"justification": the justification expected from typical expert responses, a short paragraph explaining how the new information changes the likelihood of the initial diagnosis."""
+
+PROBABILITY_DISCLAIMER = ("Please note that this percentage is an educational guess and should not replace clinical "
+                          "judgment or professional diagnostic procedures.")
+
+
+def format_expert_content(expert_content):
+    # The same sections the rationale prompt asks the model to write when there is no stored content
+    return (f"**Probability**\n\nEstimated probability: {expert_content['probability']}. {PROBABILITY_DISCLAIMER}"
+            f"\n\n**Expert Justification**\n\n{expert_content['justification']}\n\n")
+
+
+def build_case_prompt(case):
+    return (f"Case:\n{case['case']}\n\nCorrect Answer: {case['answer']}\n\n"
+            f"Correct Justification: {case['justification']}")
+
+
+async def generate_expert_content(adapter, llm_configuration, case, semaphore):
+    async with semaphore:
+        completion = await adapter.complete(llm_configuration, EXPERT_CONTENT_PROMPT, [], build_case_prompt(case),
+                                            json_mode=True)
+    text = completion["text"]
+    data = json.loads(text[text.find("{"):text.rfind("}") + 1])
+    return {
+        "probability": str(data["probability"]).strip(),
+        "justification": data["justification"].strip(),
+        "model": llm_configuration["model"],
+        "generated_at": int(time.time()),
+    }
+
+
+async def precompute(cases, adapter, llm_configuration, concurrency, force=False):
+    # Fills in expert_content in place; returns the ids of cases that failed
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = [case for case in cases if force or not case.get("expert_content")]
+    results = await asyncio.gather(*[generate_expert_content(adapter, llm_configuration, case, semaphore)
+                                     for case in pending], return_exceptions=True)
+    failed = []
+    for case, result in zip(pending, results):
+        if isinstance(result, Exception):
+            print(f"{case['id']}: {result}", file=sys.stderr)
+            failed.append(case["id"])
+        else:
+            case["expert_content"] = result
+    return len(pending), failed
+
+
+def write_cases(path, cases):
+    # Replaced in one step; the changed size and mtime make CaseBank rebuild its index on next open
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as cases_file:
+        for case in cases:
+            cases_file.write(json.dumps(case, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+
+    from config import CLIENT_POOL, LLM_CONFIGURATIONS, RATE_LIMITS
+    from llm_adapters import get_adapter
+    from llm_clients import registry_from_env
+    from rate_limit import RateLimitedAdapter, RateLimiterRegistry
+
+    parser = argparse.ArgumentParser(description="Generate the per-case expert content used by the rationale phase.")
+    parser.add_argument("cases", help="Case bank JSONL file, updated in place")
+    parser.add_argument("--model", default="gpt-4o", choices=sorted(LLM_CONFIGURATIONS), help="Key in LLM_CONFIGURATIONS")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--force", action="store_true", help="Regenerate content that already exists")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    llm_configuration = dict(LLM_CONFIGURATIONS[args.model], temperature=0)
+    registry = registry_from_env(CLIENT_POOL)
+    adapter = RateLimitedAdapter(get_adapter(llm_configuration["provider"], registry), RateLimiterRegistry(RATE_LIMITS))
+    with open(args.cases, encoding="utf-8") as cases_file:
+        cases = [json.loads(line) for line in cases_file if line.strip()]
+    generated, failed = asyncio.run(precompute(cases, adapter, llm_configuration, args.concurrency, args.force))
+    write_cases(args.cases, cases)
+    print(f"{generated - len(failed)} of {generated} cases updated, {len(cases) - generated} already had content")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import inspect
+
+import streamlit as st
+
+FIELD_FUNCTIONS = {
+    "text_input": st.text_input,
+    "text_area": st.text_area,
+    "warning": st.warning,
+    "button": st.button,
+    "radio": st.radio,
+    "markdown": st.markdown,
+    "selectbox": st.selectbox,
+    "checkbox": st.checkbox,
+    "slider": st.slider,
+    "number_input": st.number_input,
+    "image": st.image
+}
+
+# Field spec keys passed through to the Streamlit function when set (falsy values are left out)
+FIELD_OPTIONS = ("label", "body", "value", "index", "options", "max_chars", "help", "on_click", "horizontal",
+                 "min_value", "max_value", "step", "height", "unsafe_allow_html", "placeholder", "image", "caption")
+
+
+class FieldConfigError(ValueError):
+    pass
+
+
+def stored_input_key(phase_name, field_key):
+    # Where st_store (main.py) keeps the answer given in a field
+    return f"{phase_name}_{field_key}_user_input"
+
+
+class CompiledField:
+    __slots__ = ("field_key", "field_type", "function", "kwargs", "status_key", "stored_key",
+                 "accepts_value", "accepts_disabled")
+
+    def __init__(self, phase_name, field_key, field_type, function, kwargs, parameters):
+        self.field_key = field_key
+        self.field_type = field_type
+        self.function = function
+        self.kwargs = kwargs
+        self.status_key = f"{phase_name}_phase_status"
+        self.stored_key = stored_input_key(phase_name, field_key)
+        self.accepts_value = "value" in parameters and field_type != "selectbox"
+        self.accepts_disabled = "disabled" in parameters
+
+    def render(self, session_state):
+        kwargs = self.kwargs
+        # If the user has already answered this question, show their answer read-only
+        if session_state.get(self.status_key) and self.stored_key in session_state:
+            kwargs = dict(kwargs)
+            if self.accepts_value:
+                kwargs["value"] = session_state[self.stored_key]
+            if self.accepts_disabled:
+                kwargs["disabled"] = True
+        return self.function(**kwargs)
+
+
+def compile_field(phase_name, field_key, field):
+    field_type = field.get("type", "")
+    if field_type not in FIELD_FUNCTIONS:
+        raise FieldConfigError(f"Phase '{phase_name}', field '{field_key}': unknown field type '{field_type}'")
+    function = FIELD_FUNCTIONS[field_type]
+    parameters = inspect.signature(function).parameters
+    kwargs = {name: field[name] for name in FIELD_OPTIONS if field.get(name)}
+    unsupported = [name for name in kwargs if name not in parameters]
+    if unsupported:
+        raise FieldConfigError(f"Phase '{phase_name}', field '{field_key}': st.{field_type} does not accept "
+                               f"{', '.join(unsupported)}")
+    return CompiledField(phase_name, field_key, field_type, function, kwargs, parameters)
+
+
+def compile_phases(phases):
+    return {
+        phase_name: [compile_field(phase_name, field_key, field) for field_key, field in phase["fields"].items()]
+        for phase_name, phase in phases.items()
+    }
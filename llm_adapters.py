@@ -0,0 +1,233 @@
+import asyncio
+import threading
+
+
+class LLMAdapter:
+    # One subclass per provider. Adapters take the provider-neutral chat history
+    # ([{"user": ..., "assistant": ...}]) and only convert it to their own wire format when called.
+    provider = None
+    display_name = None
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def client(self, llm_configuration):
+        return self.registry.get(self.provider, llm_configuration["model"])
+
+    async def complete(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                       json_mode=False):
+        # Returns {"text": ..., "input_tokens": ..., "output_tokens": ..., "cached_tokens": ..., "cache_write_tokens": ...}
+        # where input_tokens only counts the uncached part of the prompt
+        raise NotImplementedError
+
+    async def stream(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                     json_mode=False, usage=None):
+        # Yields text deltas and fills `usage` with the token counts once the stream ends
+        raise NotImplementedError
+        yield
+
+
+class OpenAIAdapter(LLMAdapter):
+    provider = "openai"
+    display_name = "OpenAI"
+
+    def build_request(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url, json_mode):
+        # System prompt first, then history: OpenAI caches the longest previously seen prefix automatically,
+        # so the static part has to come before anything that changes from call to call
+        messages = [{"role": "system", "content": system_prompt}]
+        for history in chat_history:
+            messages.extend([{"role": "user", "content": history["user"]},
+                             {"role": "assistant", "content": history["assistant"]}])
+        if image_url:
+            messages.append({"role": "user", "content": [{"type": "image_url", "image_url": {"url": image_url}}]})
+        messages.append({"role": "user", "content": user_prompt})
+        request_kwargs = dict(
+            model=llm_configuration["model"],
+            messages=messages,
+            max_tokens=llm_configuration.get("max_tokens", 1000),
+            temperature=llm_configuration.get("temperature", 1),
+            top_p=llm_configuration.get("top_p", 1),
+            frequency_penalty=llm_configuration.get("frequency_penalty", 0),
+            presence_penalty=llm_configuration.get("presence_penalty", 0)
+        )
+        if json_mode:
+            request_kwargs["response_format"] = {"type": "json_object"}
+        return request_kwargs
+
+    async def complete(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                       json_mode=False):
+        request_kwargs = self.build_request(llm_configuration, system_prompt, chat_history, user_prompt,
+                                            image_url, json_mode)
+        response = await self.client(llm_configuration).chat.completions.create(**request_kwargs)
+        completion = {"text": response.choices[0].message.content}
+        self.read_usage(response.usage, completion)
+        return completion
+
+    def read_usage(self, response_usage, usage):
+        details = getattr(response_usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        usage["input_tokens"] = response_usage.prompt_tokens - cached_tokens
+        usage["cached_tokens"] = cached_tokens
+        usage["output_tokens"] = response_usage.completion_tokens
+
+    async def stream(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                     json_mode=False, usage=None):
+        request_kwargs = self.build_request(llm_configuration, system_prompt, chat_history, user_prompt,
+                                            image_url, json_mode)
+        response = await self.client(llm_configuration).chat.completions.create(
+            **request_kwargs, stream=True, stream_options={"include_usage": True})
+        async for chunk in response:
+            # With include_usage the final chunk carries the usage and no choices
+            if chunk.usage and usage is not None:
+                self.read_usage(chunk.usage, usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class GeminiAdapter(LLMAdapter):
+    provider = "gemini"
+    display_name = "Gemini"
+
+    def start_chat(self, llm_configuration, system_prompt, chat_history, json_mode):
+        generation_config = {
+            "temperature": llm_configuration["temperature"],
+            "top_p": llm_configuration.get("top_p", 1),
+            "max_output_tokens": llm_configuration.get("max_tokens", 1000),
+            "response_mime_type": "application/json" if json_mode else "text/plain",
+        }
+        model = self.client(llm_configuration).GenerativeModel(
+            llm_configuration["model"],
+            generation_config=generation_config,
+            system_instruction=system_prompt,
+        )
+        message_history = []
+        for history in chat_history:
+            message_history.extend([{"role": "user", "parts": [history["user"]]},
+                                    {"role": "model", "parts": [history["assistant"]]}])
+        return model.start_chat(history=message_history)
+
+    def read_usage(self, response, usage):
+        usage_metadata = getattr(response, "usage_metadata", None)
+        cached_tokens = getattr(usage_metadata, "cached_content_token_count", 0) or 0
+        usage["input_tokens"] = (getattr(usage_metadata, "prompt_token_count", 0) or 0) - cached_tokens
+        usage["cached_tokens"] = cached_tokens
+        usage["output_tokens"] = getattr(usage_metadata, "candidates_token_count", 0) or 0
+
+    async def complete(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                       json_mode=False):
+        chat_session = self.start_chat(llm_configuration, system_prompt, chat_history, json_mode)
+        response = await chat_session.send_message_async(user_prompt)
+        completion = {"text": response.text}
+        self.read_usage(response, completion)
+        return completion
+
+    async def stream(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                     json_mode=False, usage=None):
+        chat_session = self.start_chat(llm_configuration, system_prompt, chat_history, json_mode)
+        response = await chat_session.send_message_async(user_prompt, stream=True)
+        async for chunk in response:
+            yield chunk.text
+        if usage is not None:
+            self.read_usage(response, usage)
+
+
+class AnthropicAdapter(LLMAdapter):
+    provider = "anthropic"
+    display_name = "Anthropic"
+
+    def build_request(self, llm_configuration, system_prompt, chat_history, user_prompt):
+        prompt_caching = llm_configuration.get("prompt_caching", False)
+        system_block = {"type": "text", "text": system_prompt}
+        if prompt_caching:
+            system_block["cache_control"] = {"type": "ephemeral"}
+        message_history = []
+        for history in chat_history:
+            message_history.extend([{"role": "user", "content": [{"type": "text", "text": history["user"]}]},
+                                    {"role": "assistant", "content": [{"type": "text", "text": history["assistant"]}]}])
+        if prompt_caching and message_history:
+            # Second breakpoint after the history, so revisions reuse the previous turns as well
+            message_history[-1]["content"][-1]["cache_control"] = {"type": "ephemeral"}
+        return dict(
+            model=llm_configuration["model"],
+            max_tokens=llm_configuration["max_tokens"],
+            temperature=llm_configuration["temperature"],
+            system=[system_block],
+            messages=message_history + [
+                {"role": "user", "content": [{"type": "text", "text": user_prompt}]},
+            ]
+        )
+
+    def to_completion(self, anthropic_response):
+        # Anthropic reports cache reads and writes separately from the regular input tokens
+        response_usage = anthropic_response.usage
+        return {
+            "text": '\n'.join([block.text for block in anthropic_response.content if block.type == 'text']),
+            "input_tokens": response_usage.input_tokens,
+            "cached_tokens": getattr(response_usage, "cache_read_input_tokens", 0) or 0,
+            "cache_write_tokens": getattr(response_usage, "cache_creation_input_tokens", 0) or 0,
+            "output_tokens": response_usage.output_tokens,
+        }
+
+    async def complete(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                       json_mode=False):
+        request_kwargs = self.build_request(llm_configuration, system_prompt, chat_history, user_prompt)
+        anthropic_response = await self.client(llm_configuration).messages.create(**request_kwargs)
+        return self.to_completion(anthropic_response)
+
+    async def stream(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                     json_mode=False, usage=None):
+        request_kwargs = self.build_request(llm_configuration, system_prompt, chat_history, user_prompt)
+        async with self.client(llm_configuration).messages.stream(**request_kwargs) as anthropic_stream:
+            async for text in anthropic_stream.text_stream:
+                yield text
+            anthropic_response = await anthropic_stream.get_final_message()
+        if usage is not None:
+            usage.update(self.to_completion(anthropic_response))
+
+
+ADAPTERS = {
+    "openai": OpenAIAdapter,
+    "gemini": GeminiAdapter,
+    "anthropic": AnthropicAdapter,
+}
+
+
+def get_adapter(provider, registry):
+    if provider not in ADAPTERS:
+        raise ValueError(f"Unknown provider: {provider}")
+    return ADAPTERS[provider](registry)
+
+
+def completion_cost(llm_configuration, usage):
+    price_input = llm_configuration["price_input_token_1M"]
+    input_price = int(usage.get("input_tokens", 0)) * price_input / 1000000
+    cached_price = int(usage.get("cached_tokens", 0)) * llm_configuration.get(
+        "price_cached_input_token_1M", price_input) / 1000000
+    cache_write_price = int(usage.get("cache_write_tokens", 0)) * llm_configuration.get(
+        "price_cache_write_token_1M", price_input) / 1000000
+    output_price = int(usage.get("output_tokens", 0)) * llm_configuration["price_output_token_1M"] / 1000000
+    return input_price + cached_price + cache_write_price + output_price
+
+
+class EventLoopThread:
+    # A single long-lived event loop in a daemon thread. Streamlit script threads hand their
+    # coroutines to it, so requests from every session run concurrently on one loop and the
+    # async clients in the registry are always used from the loop they were created on.
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="llm-event-loop", daemon=True)
+        self.thread.start()
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def iterate(self, async_generator):
+        try:
+            while True:
+                try:
+                    yield self.run(async_generator.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(async_generator.aclose())
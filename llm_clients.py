@@ -0,0 +1,124 @@
+import os
+import threading
+
+# Environment variable holding each provider's API key (loaded from .env, see .env_sample)
+API_KEY_VARIABLES = {
+    "openai": "MSCT_API_KEY",
+    "gemini": "GOOGLE_API_KEY",
+    "anthropic": "CLAUDE_API_KEY",
+}
+
+
+def merge_pool_config(pool_config, provider, model):
+    # Later entries win: defaults, then the provider section, then the model section
+    merged = dict(pool_config.get("default", {}))
+    merged.update(pool_config.get(provider, {}))
+    merged.update(pool_config.get(model, {}))
+    return merged
+
+
+class ClientRegistry:
+    # Process-wide registry of async provider clients, one per (provider, model), so HTTP keep-alive
+    # connections and TLS sessions survive across reruns and sessions. The clients are bound to the
+    # event loop they are first used on, see llm_adapters.EventLoopThread.
+    # Provider SDKs are imported when their first client is built, so a worker only pays the import
+    # time and memory of the providers its sessions actually use (see benchmarks/bench_startup.py).
+
+    def __init__(self, pool_config, api_keys):
+        self.pool_config = pool_config
+        self.api_keys = api_keys
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._stats = {}
+        self._gemini_configured = False
+
+    def get(self, provider, model):
+        key = (provider, model)
+        with self._lock:
+            if key in self._clients:
+                self._stats[key]["client_reuses"] += 1
+                return self._clients[key]
+            config = merge_pool_config(self.pool_config, provider, model)
+            self._stats[key] = {
+                "max_connections": config.get("max_connections"),
+                "max_keepalive_connections": config.get("max_keepalive_connections"),
+                "client_reuses": 0,
+                "requests": 0,
+                "connections_opened": 0,
+                "tls_handshakes": 0,
+            }
+            client = self._build(provider, config, self._stats[key])
+            self._clients[key] = client
+            return client
+
+    def stats(self):
+        with self._lock:
+            report = {}
+            for (provider, model), stats in self._stats.items():
+                entry = dict(stats)
+                # Every request that did not open a TCP connection went over a pooled keep-alive one
+                entry["connection_reuses"] = max(stats["requests"] - stats["connections_opened"], 0)
+                report[f"{provider}/{model}"] = entry
+            return report
+
+    def _build(self, provider, config, stats):
+        if provider == "openai":
+            import openai
+            return openai.AsyncOpenAI(
+                api_key=self.api_keys.get("openai"),
+                base_url=config.get("base_url"),
+                timeout=config.get("timeout", 60),
+                max_retries=config.get("max_retries", 2),
+                http_client=openai.DefaultAsyncHttpxClient(limits=self._limits(config),
+                                                           event_hooks={"request": [self._trace_hook(stats)]}),
+            )
+        if provider == "anthropic":
+            import anthropic
+            return anthropic.AsyncAnthropic(
+                api_key=self.api_keys.get("anthropic"),
+                base_url=config.get("base_url"),
+                timeout=config.get("timeout", 60),
+                max_retries=config.get("max_retries", 2),
+                http_client=anthropic.DefaultAsyncHttpxClient(limits=self._limits(config),
+                                                              event_hooks={"request": [self._trace_hook(stats)]}),
+            )
+        if provider == "gemini":
+            import google.generativeai as generativeai
+            # generativeai keeps one channel per process; reconfiguring it drops the open connection
+            if not self._gemini_configured:
+                client_options = {"api_endpoint": config["base_url"]} if config.get("base_url") else None
+                generativeai.configure(api_key=self.api_keys.get("gemini"), transport=config.get("transport"),
+                                       client_options=client_options)
+                self._gemini_configured = True
+            return generativeai
+        raise ValueError(f"Unknown provider: {provider}")
+
+    def _limits(self, config):
+        import httpx
+        return httpx.Limits(
+            max_connections=config.get("max_connections"),
+            max_keepalive_connections=config.get("max_keepalive_connections"),
+            keepalive_expiry=config.get("keepalive_expiry"),
+        )
+
+    def _trace_hook(self, stats):
+        # httpx awaits event hooks and httpcore awaits trace callbacks on async clients
+        async def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                with self._lock:
+                    stats["connections_opened"] += 1
+            elif event_name == "connection.start_tls.complete":
+                with self._lock:
+                    stats["tls_handshakes"] += 1
+
+        async def on_request(request):
+            with self._lock:
+                stats["requests"] += 1
+            request.extensions["trace"] = trace
+
+        return on_request
+
+
+def registry_from_env(pool_config):
+    api_keys = {provider: os.getenv(variable) for provider, variable in API_KEY_VARIABLES.items()}
+    return ClientRegistry(pool_config, api_keys)
@@ -1,236 +1,437 @@
-import openai
-import google.generativeai as generativeai
-import anthropic
-import os
 import importlib
 from dotenv import load_dotenv
-import re
+import random
+import secrets
+import time
+import threading
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-from streamlit_extras.stylable_container import stylable_container
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from streamlit_extras.let_it_rain import rain
+from context_window import estimate_tokens, fit_history, format_transcript, history_tokens
+from debug_panel import render_session_debug_panel
+from fields import compile_phases, stored_input_key
+from llm_adapters import ADAPTERS, EventLoopThread, completion_cost, get_adapter
+from llm_clients import registry_from_env
+from rate_limit import RateLimitedAdapter, RateLimiterRegistry
+from routing import Router, with_session_settings
+from rendering import history_page, history_page_count, inject_field_styles, reveal_message
+from response_cache import build_cache, is_cacheable, make_cache_key
+from telemetry import TOKEN_TYPES, Telemetry, serve_metrics, timed_chunks
+from session_store import build_session_store, changed_values, persisted_state
+from budget import SessionBudget, build_ledger, estimate_input_tokens, resolve_cohort, worst_case_cost
+from pregrade import SEND_BACK_VERDICTS, ReferenceIndex, local_feedback, pregrade_batch
+from scoring import build_scoring_instructions, build_structured_scoring_instructions, extract_score, \
+    parse_structured_feedback
 
 load_dotenv()
 
 from config import *
 
+
+@st.cache_resource
+def get_session_store():
+    return build_session_store(SESSION_STORE)
+
+
+def progress_marker():
+    # Changes on every phase transition, skip and revision, and costs O(phases) to compute
+    return [st.session_state.get('CURRENT_PHASE')] + [
+        [st.session_state.get(f"{phase_name}_{key}") for key in ("phase_completed", "skipped", "revision_count")]
+        for phase_name in PHASES]
+
+
+def checkpoint_session():
+    # Queues the progress keys that changed since the last checkpoint; the store writes them in the background.
+    # Serializing the session is O(session size), so it only happens when the progress marker moved
+    if not SESSION_STORE.get("enabled", False) or "session_id" not in st.session_state:
+        return
+    marker = progress_marker()
+    if st.session_state.get("_session_store_marker") == marker:
+        return
+    st.session_state["_session_store_marker"] = marker
+    written = st.session_state.setdefault("_session_store_written", {})
+    changes = changed_values(persisted_state(st.session_state, PHASES), written)
+    get_session_store().checkpoint(st.session_state["session_id"], changes)
+
+
+if SESSION_STORE.get("enabled", False) and "session_id" not in st.session_state:
+    # A new browser session: continue the stored session named in the URL, or start a new one
+    session_id = st.query_params.get("session")
+    if session_id:
+        restored_state = get_session_store().load(session_id)
+        st.session_state.update(restored_state)
+        changed_values(restored_state, st.session_state.setdefault("_session_store_written", {}))
+    else:
+        session_id = secrets.token_urlsafe(16)
+        st.query_params["session"] = session_id
+    st.session_state["session_id"] = session_id
+
 if "CURRENT_PHASE" not in st.session_state:
     st.session_state['additional_prompt'] = ""
     st.session_state['chat_history'] = []
     st.session_state['CURRENT_PHASE'] = 0
     st.session_state['TOTAL_PRICE'] = 0
-
-def randomize_key():
-    return random.choice(list(DISEASE_GENERATOR.keys()))
+    st.session_state['CACHE_HITS'] = 0
+    st.session_state['CACHE_MISSES'] = 0
+    st.session_state['TOKENS_SAVED'] = 0
+    st.session_state['LAST_TOKENS_SAVED'] = 0
+
+def assign_case():
+    # Picked once per session from a seeded RNG; ?seed=<n> reproduces a session's case and ?case=<id> pins it
+    case_id = st.query_params.get("case")
+    if case_id in DISEASE_GENERATOR:
+        return None, case_id
+    seed = st.query_params.get("seed") or secrets.randbits(64)
+    rng = random.Random(str(seed))
+    return seed, DISEASE_GENERATOR.sample(CASE_SELECTION["stratify_by"], rng=rng)
 
 if "random_key" not in st.session_state:
-    st.session_state["random_key"] = randomize_key()
+    st.session_state["case_seed"], st.session_state["random_key"] = assign_case()
+
+if "cohort" not in st.session_state:
+    st.session_state["cohort"] = resolve_cohort(BUDGET, st.query_params.get("cohort"))
+
+PHASES = build_phases(st.session_state["random_key"])
+# Every phase transition, skip and revision ends with st.rerun, so the run that follows checkpoints it
+checkpoint_session()
+
+
+
+
+@st.cache_resource
+def get_client_registry():
+    return registry_from_env(CLIENT_POOL)
+
+
+@st.cache_resource
+def get_event_loop():
+    return EventLoopThread()
+
+
+@st.cache_resource
+def get_rate_limiters():
+    return RateLimiterRegistry(RATE_LIMITS)
+
 
-st.session_state["random_key"] = randomize_key()
+def get_llm_adapter(provider):
+    return RateLimitedAdapter(get_adapter(provider, get_client_registry()), get_rate_limiters())
 
 
-openai.api_key = os.getenv("MSCT_API_KEY")
-gemini_api_key = os.getenv('GOOGLE_API_KEY')
-claude_api_key = os.getenv('CLAUDE_API_KEY')
+@st.cache_resource
+def get_router():
+    # Shared by all sessions, so fallbacks and hedge thresholds see every session's latencies
+    return Router(LLM_CONFIGURATIONS, {provider: get_llm_adapter(provider) for provider in ADAPTERS})
+
+
+@st.cache_resource
+def get_telemetry():
+    telemetry = Telemetry(TELEMETRY.get("log_calls", True))
+    if TELEMETRY.get("metrics_port"):
+        try:
+            serve_metrics(telemetry, TELEMETRY.get("metrics_host", "127.0.0.1"), TELEMETRY["metrics_port"])
+        except OSError as e:
+            telemetry.logger.warning(f"Metrics endpoint not started: {e}")
+    return telemetry
+
+
+@st.cache_resource
+def get_response_cache():
+    return build_cache(RESPONSE_CACHE)
+
+
+@st.cache_resource
+def get_compiled_phases(case_id):
+    return compile_phases(build_phases(case_id))
+
+
+@st.cache_resource
+def get_budget_ledger():
+    return build_ledger(BUDGET)
+
+
+@st.cache_resource
+def get_reference_index():
+    return ReferenceIndex(DISEASE_GENERATOR.scan())
+
 
 user_input = {}
-function_map = {
-    "text_input": st.text_input,
-    "text_area": st.text_area,
-    "warning": st.warning,
-    "button": st.button,
-    "radio": st.radio,
-    "markdown": st.markdown,
-    "selectbox": st.selectbox,
-    "checkbox": st.checkbox,
-    "slider": st.slider,
-    "number_input": st.number_input,
-    "image": st.image
-}
-
-
-def build_field(phase_name, fields):
-    for field_key, field in fields.items():
-        field_type = field.get("type", "")
-        field_label = field.get("label", "")
-        field_body = field.get("body", "")
-        field_value = field.get("value", "")
-        field_index = field.get("index",None)
-        field_max_chars = field.get("max_chars", None)
-        field_help = field.get("help", "")
-        field_on_click = field.get("on_click", None)
-        field_options = field.get("options", [])
-        field_horizontal = field.get("horizontal", False)
-        field_min_value = field.get("min_value",None)
-        field_max_value = field.get("max_value",None)
-        field_step = field.get("step",None)
-        field_height = field.get("height", None)
-        field_unsafe_html = field.get("unsafe_allow_html", False)
-        field_placeholder = field.get("placeholder", "")
-        field_image = field.get("image", "")
-        field_caption = field.get("caption", "")
-
-        kwargs = {}
-        if field_label:
-            kwargs['label'] = field_label
-        if field_body:
-            kwargs['body'] = field_body
-        if field_value:
-            kwargs['value'] = field_value
-        if field_index:
-            kwargs['index'] = field_index
-        if field_options:
-            kwargs['options'] = field_options
-        if field_max_chars:
-            kwargs['max_chars'] = field_max_chars
-        if field_help:
-            kwargs['help'] = field_help
-        if field_on_click:
-            kwargs['on_click'] = field_on_click
-        if field_horizontal:
-            kwargs['horizontal'] = field_horizontal
-        if field_min_value:
-            kwargs['min_value'] = field_min_value
-        if field_max_value:
-            kwargs['max_value'] = field_max_value
-        if field_step:
-            kwargs['step'] = field_step
-        if field_height:
-            kwargs['height'] = field_height
-        if field_unsafe_html:
-            kwargs['unsafe_allow_html'] = field_unsafe_html
-        if field_placeholder:
-            kwargs['placeholder'] = field_placeholder
-        if field_image:
-            kwargs['image'] = field_image
-        if field_caption:
-            kwargs['caption'] = field_caption
-
-
-        key = f"{phase_name}_phase_status"
-
-        # If the user has already answered this question:
-        if key in st.session_state and st.session_state[key]:
-            # Write their answer
-            if f"{phase_name}_user_input_{field_key}" in st.session_state:
-                if field_type != "selectbox":
-                    kwargs['value'] = st.session_state[f"{phase_name}_user_input_{field_key}"]
-                kwargs['disabled'] = True
-
-        my_input_function = function_map[field_type]
-
-        with stylable_container(
-                key="large_label",
-                css_styles="""
-                label p {
-                    font-weight: bold;
-                    font-size: 16px;
-                }
-
-                div[role="radiogroup"] label p{
-                    font-weight: unset !important;
-                    font-size: unset !important;
-                }
-                """,
-        ):
-            user_input[field_key] = my_input_function(**kwargs)
-
-
-def call_openai_completions(phase_instructions, user_prompt, image_url=None):
+
+
+def build_field(phase_name):
+    for compiled_field in get_compiled_phases(st.session_state["random_key"])[phase_name]:
+        user_input[compiled_field.field_key] = compiled_field.render(st.session_state)
+
+
+def render_stream(res_box, text_chunks):
+    # Throttle frontend updates: the first token is shown immediately, then at most one update per interval
+    parts = []
+    last_render = 0
+    for text in text_chunks:
+        if not text:
+            continue
+        parts.append(text)
+        now = time.monotonic()
+        if now - last_render >= STREAM_RENDER_INTERVAL:
+            res_box.info(body="".join(parts), icon="🤖")
+            last_render = now
+    response_text = "".join(parts)
+    res_box.info(body=response_text, icon="🤖")
+    return response_text
+
+
+# Scoring can run in a worker thread next to the feedback call, so session counters need a lock
+stats_lock = threading.Lock()
+
+
+def get_session_budget():
+    # None when BUDGET is off. Created on the session's first call, from the spend of a restored session
+    if not BUDGET.get("enabled", False):
+        return None
+    with stats_lock:
+        if "_session_budget" not in st.session_state:
+            st.session_state["_session_budget"] = SessionBudget(BUDGET, get_budget_ledger(), st.session_state["cohort"],
+                                                                st.session_state['TOTAL_PRICE'])
+        return st.session_state["_session_budget"]
+
+
+def add_to_total_price(total_price, reserved=False):
+    # reserved: the cost settled a budget reservation, which already counted it against the budget
+    with stats_lock:
+        st.session_state['TOTAL_PRICE'] += total_price
+    session_budget = get_session_budget()
+    if session_budget and total_price and not reserved:
+        session_budget.add(total_price)
+
+
+def remaining_session_budget():
+    session_budget = get_session_budget()
+    return session_budget.remaining() if session_budget else None
+
+
+def show_notice(notices, kind, text):
+    # st.<kind>(text), or queued in notices when called from a worker thread: Streamlit's element writes are not
+    # thread-safe, so a worker's notices are rendered by the script thread once it has joined the worker
+    if notices is None:
+        getattr(st, kind)(text)
+    else:
+        notices.append((kind, text))
+
+
+def budget_call(session_budget, llm_configuration, input_tokens, image_url=None, notices=None):
+    # The configuration to call with under the session's and cohort's remaining budget, with its worst-case cost
+    # reserved, see BUDGET; None if none fits. A cheaper model keeps the session's sampling settings
+    cheaper_configurations = {name: with_session_settings(configuration, llm_configuration)
+                              for name, configuration in LLM_CONFIGURATIONS.items()}
+    planned_configuration, downgraded_to = session_budget.plan(llm_configuration, cheaper_configurations, input_tokens,
+                                                               BUDGET.get("min_output_tokens", 150), bool(image_url))
+    if downgraded_to:
+        show_notice(notices, "caption", f"Budget running low, answered by {downgraded_to}")
+    return planned_configuration
+
+
+def attempt_cost(attempt, input_tokens, reserved):
+    # What an ended routing attempt is billed. Without reported usage: nothing for a call that failed before
+    # answering, the prompt and the text so far for a stream that was cut off, and the whole reservation for a
+    # plain completion cancelled in flight, which the provider may well finish anyway
+    if attempt.usage.get("input_tokens") or attempt.usage.get("output_tokens"):
+        return completion_cost(attempt.llm_configuration, attempt.usage)
+    if attempt.status == "error" and not attempt.output:
+        return 0.0
+    if attempt.mode == "stream":
+        return completion_cost(attempt.llm_configuration, {"input_tokens": input_tokens,
+                                                           "output_tokens": estimate_tokens("".join(attempt.output))})
+    return reserved
+
+
+def count_cache_lookup(hit):
+    with stats_lock:
+        st.session_state['CACHE_HITS' if hit else 'CACHE_MISSES'] += 1
+
+
+def record_tokens_saved(tokens_saved):
+    with stats_lock:
+        st.session_state['LAST_TOKENS_SAVED'] = tokens_saved
+        st.session_state['TOKENS_SAVED'] += tokens_saved
+
+
+def record_call(phase_name, llm_configuration, status, started, usage=None, timing=None, cost=None):
+    usage = usage or {}
+    call = {
+        "phase": phase_name,
+        "provider": llm_configuration["provider"],
+        "model": llm_configuration["model"],
+        "status": status,
+        "latency_seconds": time.monotonic() - started,
+        "ttft_seconds": (timing or {}).get("ttft_seconds"),
+        "queue_seconds": usage.get("queue_seconds"),
+        "cost": cost if cost is not None else completion_cost(llm_configuration, usage) if usage else 0.0,
+    }
+    call.update({token_type: usage.get(token_type, 0) for token_type in TOKEN_TYPES})
+    get_telemetry().record(call)
+    return call["cost"]
+
+
+def summarize_turns(dropped_turns, llm_configuration):
+    # Dropped turns are always a prefix of the history, so the summary is extended incrementally
+    summary = st.session_state.get('HISTORY_SUMMARY', {"turns": 0, "text": ""})
+    if summary["turns"] >= len(dropped_turns):
+        return summary["text"]
+    transcript = format_transcript(dropped_turns[summary["turns"]:])
+    if summary["text"]:
+        transcript = f"Summary so far:\n{summary['text']}\n\nContinuation:\n{transcript}"
+    summary_configuration = dict(llm_configuration, temperature=0,
+                                 max_tokens=CONTEXT_WINDOW.get("summary_max_tokens", 300))
+    adapter = get_llm_adapter(llm_configuration["provider"])
+    started = time.monotonic()
+    try:
+        completion = get_event_loop().run(
+            adapter.complete(summary_configuration, CONTEXT_WINDOW["summary_prompt"], [], transcript))
+    except Exception:
+        record_call("history_summary", llm_configuration, "error", started)
+        return summary["text"] or None
+    add_to_total_price(record_call("history_summary", llm_configuration, "ok", started, completion))
+    st.session_state['HISTORY_SUMMARY'] = {"turns": len(dropped_turns), "text": completion["text"]}
+    return completion["text"]
+
+
+def window_chat_history(llm_configuration, system_prompt, user_prompt):
+    chat_history = st.session_state["chat_history"]
+    budget = llm_configuration.get("context_budget_tokens")
+    if not budget:
+        return chat_history
+
+    available_tokens = budget - estimate_tokens(system_prompt) - estimate_tokens(user_prompt)
+    kept_turns, dropped_turns = fit_history(chat_history, available_tokens)
+    tokens_saved = history_tokens(dropped_turns)
+    if dropped_turns and CONTEXT_WINDOW.get("strategy") == "summarize":
+        summary = summarize_turns(dropped_turns, llm_configuration)
+        if summary:
+            summary_turn = {"user": "Summarize our conversation so far.", "assistant": summary}
+            kept_turns = [summary_turn] + kept_turns
+            tokens_saved -= history_tokens([summary_turn])
+    record_tokens_saved(max(tokens_saved, 0))
+    return kept_turns
+
+
+def call_openai_completions(phase_instructions, user_prompt, image_url=None, res_box=None, json_mode=False,
+                            phase_name=None, response_prefix="", notices=None):
+    llm_configuration = st.session_state['llm_config']
+    started = time.monotonic()
+    chat_history = window_chat_history(llm_configuration, SYSTEM_PROMPT + "\n" + phase_instructions, user_prompt)
+    if not RESPONSE_CACHE.get("enabled", False) or not is_cacheable(RESPONSE_CACHE, llm_configuration["temperature"]):
+        return request_completion(phase_instructions, user_prompt, chat_history, image_url, res_box, json_mode,
+                                  phase_name, response_prefix, notices=notices)
+
+    cache = get_response_cache()
+    cache_key = make_cache_key(
+        llm_configuration["model"],
+        llm_configuration["temperature"],
+        llm_configuration.get("top_p", 1),
+        llm_configuration.get("max_tokens", 1000),
+        SYSTEM_PROMPT + "\n" + phase_instructions,
+        chat_history,
+        user_prompt,
+        image_url=image_url,
+        json_mode=json_mode,
+    )
+    cached_response = cache.get(cache_key)
+    count_cache_lookup(cached_response is not None)
+    if cached_response is not None:
+        record_call(phase_name, llm_configuration, "cache_hit", started)
+        if res_box is not None:
+            res_box.info(body=cached_response, icon="🤖")
+        return cached_response
+
+    outcome = {}
+    response = request_completion(phase_instructions, user_prompt, chat_history, image_url, res_box, json_mode,
+                                  phase_name, response_prefix, outcome, notices)
+    # A reply cut short by the budget, or from a cheaper, fallback or hedge model, would otherwise be served from
+    # the cache as the session model's full reply
+    if response is not None and not outcome.get("served_by") and not outcome.get("budgeted"):
+        cache.set(cache_key, response)
+    return response
+
+
+def request_completion(phase_instructions, user_prompt, chat_history, image_url=None, res_box=None, json_mode=False,
+                       phase_name=None, response_prefix="", outcome=None, notices=None):
+    # response_prefix is precomputed text (e.g. a case's expert content) shown before the model's reply;
+    # outcome, when given, is filled with "served_by" (the routing fallback or hedge that answered, or None) and
+    # "budgeted" (whether BUDGET lowered max_tokens or moved the call to a cheaper model); notices, when given,
+    # collects errors and captions instead of rendering them, see show_notice
     selected_llm = st.session_state['selected_llm']
     llm_configuration = st.session_state['llm_config']
-    chat_history = st.session_state["chat_history"]
+    stream = STREAM_RESPONSES and res_box is not None
 
-    if image_url and selected_llm not in ["gpt-4-turbo", "gpt-4o"]:
+    if image_url and not llm_configuration.get("supports_images", False):
         return "ERROR: This model does not support image recognition"
 
-    message_history = []
-    message_history_gemini = []
-    if len(chat_history) > 0:
-        for history in chat_history:
-            user_content = history["user"]
-            assistant_content = history["assistant"]
-            message_history.extend(
-                [{"role": "user", "content": user_content}, {"role": "assistant", "content": assistant_content}])
-            message_history_gemini.extend(
-                [{"role": "user", "parts": [user_content]}, {"role": "model", "parts": [assistant_content]}])
-    if image_url:
-        messages_openai = [
-                        {"role": "system", "content": SYSTEM_PROMPT + "\n" + phase_instructions},
-                        {"role": "user", "content": [{"type": "image_url", "image_url": {"url": image_url}}]},
-                        {"role": "user", "content": user_prompt}
-                    ]
-    else:
-        messages_openai = [
-                {"role": "system", "content": SYSTEM_PROMPT + "\n" + phase_instructions},
-                {"role": "user", "content": user_prompt}
-            ]
-    if selected_llm in ["gpt-3.5-turbo", "gpt-4-turbo", "gpt-4o"]:
-        try:
-            response = openai.chat.completions.create(
-                model=llm_configuration["model"],
-                messages= message_history+messages_openai,
-                max_tokens=llm_configuration.get("max_tokens", 1000),
-                temperature=llm_configuration.get("temperature", 1),
-                top_p=llm_configuration.get("top_p", 1),
-                frequency_penalty=llm_configuration.get("frequency_penalty", 0),
-                presence_penalty=llm_configuration.get("presence_penalty", 0)
-            )
-            input_price = int(response.usage.prompt_tokens) * llm_configuration["price_input_token_1M"] / 1000000
-            output_price = int(response.usage.completion_tokens) * llm_configuration[
-                "price_output_token_1M"] / 1000000
-            total_price = input_price + output_price
-            st.session_state['TOTAL_PRICE'] += total_price
-            return response.choices[0].message.content
-        except Exception as e:
-            st.write(f"**OpenAI Error Response:** {selected_llm}")
-            st.error(f"Error: {e}")
-    if selected_llm in ["gemini-1.0-pro", "gemini-1.5-flash", "gemini-1.5-pro"]:
-        try:
-            generativeai.configure(api_key=gemini_api_key)
-            generation_config = {
-                "temperature": llm_configuration["temperature"],
-                "top_p": llm_configuration.get("top_p", 1),
-                "max_output_tokens": llm_configuration.get("max_tokens", 1000),
-                "response_mime_type": "text/plain",
-            }
-            model = generativeai.GenerativeModel(
-                llm_configuration["model"],
-                generation_config=generation_config,
-                system_instruction=SYSTEM_PROMPT + "\n" + phase_instructions,
-            )
-            chat_session = model.start_chat(
-                history= message_history_gemini
-            )
-            gemini_response = chat_session.send_message(user_prompt)
-            gemini_response_text = gemini_response.text
-
-            return gemini_response_text
-        except Exception as e:
-            st.write("**Gemini Error Response:**")
-            st.error(f"Error: {e}")
-    if selected_llm in ["claude-opus", "claude-sonnet", "claude-haiku", "claude-3.5-sonnet"]:
-        try:
-            client = anthropic.Anthropic(api_key=claude_api_key)
-            anthropic_response = client.messages.create(
-                model=llm_configuration["model"],
-                max_tokens=llm_configuration["max_tokens"],
-                temperature=llm_configuration["temperature"],
-                system=SYSTEM_PROMPT + "\n" + phase_instructions,
-                messages= message_history+[
-                    {"role": "user", "content": [{"type": "text", "text": user_prompt}]},
-                ]
-            )
-            input_price = int(anthropic_response.usage.input_tokens) * llm_configuration[
-                "price_input_token_1M"] / 1000000
-            output_price = int(anthropic_response.usage.output_tokens) * llm_configuration[
-                "price_output_token_1M"] / 1000000
-            total_price = input_price + output_price
-            response_cleaned = '\n'.join([block.text for block in anthropic_response.content if block.type == 'text'])
-            st.session_state['TOTAL_PRICE'] += total_price
-            return response_cleaned
-        except Exception as e:
-            st.write(f"**Anthropic Error Response: {selected_llm}**")
-            st.error(f"Error: {e}")
+    router = get_router()
+    system_prompt = SYSTEM_PROMPT + "\n" + phase_instructions
+    started = time.monotonic()
+    timing = {}
+    input_tokens = estimate_input_tokens(system_prompt, chat_history, user_prompt)
+    session_budget = get_session_budget()
+    plan = None
+    if session_budget:
+        planned_configuration = budget_call(session_budget, llm_configuration, input_tokens, image_url, notices)
+        if planned_configuration is None:
+            record_call(phase_name, llm_configuration, "over_budget", started)
+            show_notice(notices, "error", "The spending limit for this session has been reached.")
+            return None
+        if outcome is not None:
+            outcome["budgeted"] = planned_configuration != llm_configuration
+        llm_configuration = planned_configuration
+
+        def plan(configuration):
+            # Fallbacks and hedges are clamped and reserved like the call itself, but never moved to another model
+            return session_budget.plan(configuration, {}, input_tokens, BUDGET.get("min_output_tokens", 150),
+                                       bool(image_url))[0]
+
+    # Every attempt the router makes (the call, its fallbacks and a hedge, losers included) is priced when it ends;
+    # this runs on the event loop thread, so the attempts are recorded here once the call returns
+    ended_attempts = []
+
+    def on_end(attempt):
+        reserved = worst_case_cost(attempt.llm_configuration, input_tokens) if session_budget else 0.0
+        cost = attempt_cost(attempt, input_tokens, reserved)
+        if session_budget:
+            session_budget.settle(reserved, cost)
+        ended_attempts.append((attempt, cost))
+
+    def record_attempts():
+        add_to_total_price(sum(cost for _, cost in ended_attempts), reserved=session_budget is not None)
+        for attempt, cost in ended_attempts:
+            if attempt.status == "cancelled":
+                record_call(phase_name, attempt.llm_configuration, "cancelled", started, cost=cost)
+
+    try:
+        if stream:
+            usage = {}
+            response_text = render_stream(res_box, chain([response_prefix], timed_chunks(get_event_loop().iterate(
+                router.stream(llm_configuration, system_prompt, chat_history, user_prompt, image_url, json_mode,
+                              usage=usage, phase_name=phase_name, plan=plan, on_end=on_end)), started, timing)))
+        else:
+            usage = get_event_loop().run(
+                router.complete(llm_configuration, system_prompt, chat_history, user_prompt, image_url, json_mode,
+                                phase_name=phase_name, plan=plan, on_end=on_end))
+            response_text = response_prefix + usage["text"]
+        served_by = usage.get("served_by")
+        if outcome is not None:
+            outcome["served_by"] = served_by
+        # Record the call under the model, and the settings, that actually answered it
+        served_configuration = next((attempt.llm_configuration for attempt, _ in ended_attempts
+                                     if attempt.status == "ok"), llm_configuration)
+        record_call(phase_name, served_configuration, "ok", started, usage, timing)
+        record_attempts()
+        return response_text
+    except Exception as e:
+        record_call(phase_name, llm_configuration, "error", started, timing=timing)
+        record_attempts()
+        show_notice(notices, "write",
+                    f"**{ADAPTERS[llm_configuration['provider']].display_name} Error Response:** {selected_llm}")
+        show_notice(notices, "error", f"Error: {e}")
 
 
 def format_user_prompt(prompt, user_input, phase_name=None):
@@ -251,21 +452,53 @@ def st_store(input, phase_name, phase_key, field_key=""):
     st.session_state[key] = input
 
 
-def build_scoring_instructions(rubric):
-    scoring_instructions = f"""
-    Please score the user's previous response based on the following rubric: \n{rubric}
-    \n\nPlease output your response as JSON, using this format: {{ "[criteria 1]": "[score 1]", "[criteria 2]": "[score 2]", "total": "[total score]" }}
-    """
-    return scoring_instructions
-
-
-def extract_score(text):
-    pattern = r'"total":\s*"?(\d+)"?'
-    match = re.search(pattern, text)
-    if match:
-        return int(match.group(1))
-    else:
-        return 0
+def score_submission(phase_instructions, user_prompt, rubric, image_url=None, res_box=None, phase_name=None,
+                     response_prefix=""):
+    if SCORING_MODE == "single_call":
+        structured_instructions = build_structured_scoring_instructions(phase_instructions, rubric)
+        response = call_openai_completions(structured_instructions, user_prompt, image_url, json_mode=True,
+                                           phase_name=phase_name)
+        ai_feedback, ai_score = parse_structured_feedback(response)
+        return (response_prefix + ai_feedback if ai_feedback is not None else None), ai_score
+
+    scoring_instructions = build_scoring_instructions(rubric)
+    if SCORING_MODE == "parallel":
+        ctx = get_script_run_ctx()
+        notices = []
+
+        def score_in_thread():
+            # The context only gives the thread the session's state; it never writes to the page itself
+            add_script_run_ctx(threading.current_thread(), ctx)
+            return call_openai_completions(scoring_instructions, user_prompt, phase_name=phase_name, notices=notices)
+
+        # Score the student's answer while the feedback streams in the script thread
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            score_future = executor.submit(score_in_thread)
+            ai_feedback = call_openai_completions(phase_instructions, user_prompt, image_url, res_box=res_box,
+                                                  phase_name=phase_name, response_prefix=response_prefix)
+            ai_score = score_future.result()
+        for kind, text in notices:
+            show_notice(None, kind, text)
+        return ai_feedback, ai_score
+
+    ai_feedback = call_openai_completions(phase_instructions, user_prompt, image_url, res_box=res_box,
+                                          phase_name=phase_name, response_prefix=response_prefix)
+    if ai_feedback is None:
+        return None, None
+    ai_score = call_openai_completions(scoring_instructions, ai_feedback, phase_name=phase_name)
+    return ai_feedback, ai_score
+
+
+def pregrade_submission(phase_name, phase_dict):
+    # Local verdict on the submission (see PREGRADE), stored with the phase; None when the phase is not pregraded
+    pregrade = phase_dict.get("pregrade")
+    if not pregrade or not PREGRADE.get("enabled", False):
+        return None
+    case = DISEASE_GENERATOR[st.session_state["random_key"]]
+    likert = st.session_state.get(pregrade["likert_key"])
+    result = pregrade_batch(get_reference_index(), [case], [likert], [user_input[pregrade["field"]]], PREGRADE)[0]
+    st_store(result, phase_name, "pregrade")
+    return dict(result, feedback=local_feedback(result, case, likert))
 
 
 def check_score(PHASE_NAME):
@@ -292,6 +525,61 @@ def skip_phase(PHASE_NAME, No_Submit=False):
     st.session_state['CURRENT_PHASE'] = min(st.session_state['CURRENT_PHASE'] + 1, len(PHASES) - 1)
 
 
+def is_phase_frozen(i, phase_name, phase_dict):
+    # A phase is frozen once it is completed and can no longer be revised; it is then shown as a read-only transcript
+    if i >= st.session_state['CURRENT_PHASE'] or not st.session_state.get(f"{phase_name}_phase_completed", False):
+        return False
+    is_revisable = phase_dict.get("allow_revisions", False) and i == st.session_state['CURRENT_PHASE'] - 1 \
+        and not st.session_state.get(f"{phase_name}_skipped", False)
+    return not is_revisable
+
+
+# Bumped when the transcript format changes, so transcripts cached in (restored) sessions are rebuilt
+TRANSCRIPT_VERSION = 2
+
+
+def build_phase_transcript(phase_name, phase_dict):
+    lines = []
+    phase_input = {}
+    for field_key, field in phase_dict["fields"].items():
+        stored_key = stored_input_key(phase_name, field_key)
+        if stored_key in st.session_state:
+            phase_input[field_key] = st.session_state[stored_key]
+        field_type = field.get("type", "")
+        if field_type in ("markdown", "warning"):
+            lines.append(field.get("body", ""))
+        elif field_type == "image":
+            lines.append(f"![{field.get('caption', '')}]({field.get('image', '')})")
+        elif field_type != "button":
+            lines.append(f"**{field.get('label', '')}**\n\n{phase_input.get(field_key, '')}")
+
+    responses = [st.session_state[key] for key in (f"{phase_name}_ai_response", f"{phase_name}_ai_score_debug")
+                 if key in st.session_state]
+    for z in range(1, st.session_state.get(f"{phase_name}_revision_count", 0) + 1):
+        key = f"{phase_name}_ai_response_revision_{z}"
+        if key in st.session_state:
+            responses.append(st.session_state[key])
+    return {
+        "markdown": "\n\n".join(lines),
+        "unsafe_allow_html": any(field.get("unsafe_allow_html", False) for field in phase_dict["fields"].values()),
+        "responses": responses,
+        "user_input": phase_input,
+        "version": TRANSCRIPT_VERSION,
+    }
+
+
+def render_frozen_phase(phase_name, phase_dict):
+    transcript_key = f"{phase_name}_transcript"
+    if st.session_state.get(transcript_key, {}).get("version") != TRANSCRIPT_VERSION:
+        st.session_state[transcript_key] = build_phase_transcript(phase_name, phase_dict)
+    transcript = st.session_state[transcript_key]
+    # Later prompts can still reference the answers given in this phase
+    user_input.update(transcript["user_input"])
+    st.markdown(transcript["markdown"], unsafe_allow_html=transcript["unsafe_allow_html"])
+    for response in transcript["responses"]:
+        st.info(response, icon="🤖")
+
+
 def celebration():
     rain(
         emoji="🥳",
@@ -308,10 +596,30 @@ def find_image_url(fields):
     return None
 
 
+def render_sidebar_history(chat_history):
+    # Nothing is sent until the student switches the transcript on, then one page of turns as one element
+    st.subheader("Chat History")
+    if not chat_history or not st.toggle(f"Show chat history ({len(chat_history)} turns)", key="show_chat_history"):
+        return
+    page_size = SIDEBAR_HISTORY.get("page_size", 5)
+    pages = history_page_count(chat_history, page_size)
+    page = 1
+    if pages > 1:
+        page = st.number_input("Page (1 = latest)", min_value=1, max_value=pages, value=1, key="chat_history_page")
+    markdown, first_turn, last_turn = history_page(chat_history, page, page_size)
+    st.caption(f"Turns {first_turn}-{last_turn} of {len(chat_history)}")
+    st.markdown(markdown)
+
+
 def main():
     st.set_page_config(initial_sidebar_state="collapsed")
+    # Compiling every phase on the first run rejects bad field specs before a session gets halfway through
+    get_compiled_phases(st.session_state["random_key"])
+    # Starts the /metrics endpoint with the first session rather than the first LLM call
+    get_telemetry()
 
-    st.json(st.session_state)
+    if SESSION_DEBUG_PANEL:
+        render_session_debug_panel()
 
 
     if 'TOTAL_PRICE' not in st.session_state:
@@ -322,9 +630,8 @@ def main():
         # Get the initial LLM configuration from the selected model
         initial_config = LLM_CONFIGURATIONS[selected_llm]
 
-        # Parameter adjustment inputs
-        st.session_state['llm_config'] = {
-            "model": initial_config["model"],
+        # Parameter adjustment inputs override the model's configuration; everything else is passed through
+        st.session_state['llm_config'] = dict(initial_config, **{
             "temperature": st.slider("Temperature", min_value=0.0, max_value=1.0,
                                      value=float(initial_config.get("temperature", 1.0)), step=0.01),
             "max_tokens": st.slider("Max Tokens", min_value=50, max_value=4000,
@@ -336,21 +643,39 @@ def main():
                                           value=float(initial_config.get("presence_penalty", 0.0)), step=0.01),
             "price_input_token_1M": st.number_input("Input Token Price 1M", value=initial_config.get("price_input_token_1M", 0)),
             "price_output_token_1M": st.number_input("Output Token Price 1M", value=initial_config.get("price_output_token_1M", 0))
-        }
+        })
 
         if DISPLAY_COST:
             st.write("Price : ${:.6f}".format(st.session_state['TOTAL_PRICE']))
-
-        with st.sidebar:
-            st.subheader("Chat History")
-            for history in st.session_state['chat_history']:
-                st.markdown(f"**User:** {history['user']}")
-                st.markdown(f"**AI:** {history['assistant']}")
-                st.markdown("---")
+            remaining = remaining_session_budget()
+            if remaining is not None:
+                st.write("Budget : ${:.4f} left".format(max(remaining, 0)))
+            if RESPONSE_CACHE.get("enabled", False):
+                st.write("Cache : {} hits / {} misses".format(st.session_state['CACHE_HITS'],
+                                                              st.session_state['CACHE_MISSES']))
+            if st.session_state['llm_config'].get("context_budget_tokens"):
+                st.write("Context : {} tokens saved last call / {} total".format(
+                    st.session_state['LAST_TOKENS_SAVED'], st.session_state['TOKENS_SAVED']))
+
+        if DISPLAY_CLIENT_POOL_STATS:
+            with st.expander("Connection pool"):
+                st.json(get_client_registry().stats())
+            with st.expander("Rate limits"):
+                st.json(get_rate_limiters().stats())
+            with st.expander("Routing"):
+                st.json(get_router().stats())
+
+        if DISPLAY_LATENCY_STATS:
+            with st.expander("Latency (all sessions)"):
+                st.json(get_telemetry().summary())
+
+        if SIDEBAR_HISTORY.get("enabled", True):
+            render_sidebar_history(st.session_state['chat_history'])
 
     if 'CURRENT_PHASE' not in st.session_state:
         st.session_state['CURRENT_PHASE'] = 0
 
+    inject_field_styles()
     st.title(APP_TITLE)
     st.markdown(APP_INTRO)
 
@@ -382,7 +707,12 @@ def main():
 
         st.write(f"#### Phase {i + 1}: {PHASE_DICT['name']}")
 
-        build_field(PHASE_NAME, fields)
+        if is_phase_frozen(i, PHASE_NAME, PHASE_DICT):
+            render_frozen_phase(PHASE_NAME, PHASE_DICT)
+            i = min(i + 1, len(PHASES))
+            continue
+
+        build_field(PHASE_NAME)
 
         key = f"{PHASE_NAME}_phase_status"
 
@@ -427,15 +757,10 @@ def main():
         if key in st.session_state:
             st.info(st.session_state[key], icon="🤖")
 
-        key = f"{PHASE_NAME}_ai_response_revision_1"
-        # If there are any revisions, enter the loop
-        if key in st.session_state:
-            z = 1
-            while z <= PHASE_DICT.get("max_revisions",10):
-                key = f"{PHASE_NAME}_ai_response_revision_{z}"
-                if key in st.session_state:
-                    st.info(st.session_state[key], icon="🤖")
-                z += 1
+        for z in range(1, st.session_state.get(f"{PHASE_NAME}_revision_count", 0) + 1):
+            key = f"{PHASE_NAME}_ai_response_revision_{z}"
+            if key in st.session_state:
+                st.info(st.session_state[key], icon="🤖")
 
         if submit_button:
             for field_key, field in fields.items():
@@ -447,12 +772,22 @@ def main():
             image_url = find_image_url(PHASE_DICT.get('fields', {}))
 
             if PHASE_DICT.get("ai_response", True):
+                pregrade = pregrade_submission(PHASE_NAME, PHASE_DICT)
+                if pregrade and pregrade["verdict"] in SEND_BACK_VERDICTS:
+                    # Not a rationale yet; keep the phase open without spending an LLM call on it
+                    st.warning(pregrade["feedback"])
+                    st.stop()
                 if PHASE_DICT.get("scored_phase", False):
                     if "rubric" in PHASE_DICT:
-                        scoring_instructions = build_scoring_instructions(PHASE_DICT["rubric"])
-                        ai_feedback = call_openai_completions(phase_instructions, formatted_user_prompt, image_url)
-                        st.info(body=ai_feedback, icon="🤖")
-                        ai_score = call_openai_completions(scoring_instructions, ai_feedback)
+                        res_box = st.empty()
+                        ai_feedback, ai_score = score_submission(phase_instructions, formatted_user_prompt,
+                                                                 PHASE_DICT["rubric"], image_url, res_box=res_box,
+                                                                 phase_name=PHASE_NAME,
+                                                                 response_prefix=PHASE_DICT.get("response_prefix", ""))
+                        if ai_feedback is None or ai_score is None:
+                            # The error is already shown; keep the phase open so the student can submit again
+                            st.stop()
+                        res_box.info(body=ai_feedback, icon="🤖")
                         st.info(ai_score, icon="🤖")
                         st_store(ai_feedback, PHASE_NAME, "ai_response")
                         st_store(ai_score, PHASE_NAME, "ai_score_debug")
@@ -473,7 +808,15 @@ def main():
                     else:
                         st.error('You need to include a rubric for a scored phase', icon="🚨")
                 else:
-                    ai_feedback = call_openai_completions(phase_instructions, formatted_user_prompt, image_url)
+                    if pregrade and pregrade["verdict"] in PREGRADE.get("local_feedback", []):
+                        ai_feedback = PHASE_DICT.get("response_prefix", "") + pregrade["feedback"]
+                        reveal_message(st.empty(), ai_feedback, CUSTOM_RESPONSE_REVEAL)
+                    else:
+                        ai_feedback = call_openai_completions(phase_instructions, formatted_user_prompt, image_url,
+                                                              res_box=st.empty(), phase_name=PHASE_NAME,
+                                                              response_prefix=PHASE_DICT.get("response_prefix", ""))
+                    if ai_feedback is None:
+                        st.stop()
                     st_store(ai_feedback, PHASE_NAME, "ai_response")
                     st.session_state['chat_history'].append({
                         "user": formatted_user_prompt,
@@ -483,13 +826,9 @@ def main():
                     st.session_state[f"{PHASE_NAME}_phase_completed"] = True
                     st.rerun()
             else:
-                res_box = st.info(body="", icon="🤖")
-                result = ""
                 hard_coded_message = PHASE_DICT.get('custom_response', None)
                 hard_coded_message = format_user_prompt(hard_coded_message, user_input, PHASE_NAME)
-                for char in hard_coded_message:
-                    result += char
-                    res_box.info(body=result, icon="🤖")
+                reveal_message(st.empty(), hard_coded_message, CUSTOM_RESPONSE_REVEAL)
                 st.session_state[f"{PHASE_NAME}_ai_response"] = hard_coded_message
                 st.session_state['chat_history'].append({
                     "user": formatted_user_prompt,
@@ -527,7 +866,12 @@ def main():
 
                                 formatted_user_prompt += st.session_state['additional_prompt']
 
-                                ai_feedback = call_openai_completions(phase_instructions, formatted_user_prompt)
+                                ai_feedback = call_openai_completions(phase_instructions, formatted_user_prompt,
+                                                                      res_box=st.empty(), phase_name=PHASE_NAME,
+                                                                      response_prefix=PHASE_DICT.get("response_prefix", ""))
+                                if ai_feedback is None:
+                                    st.session_state[f"{PHASE_NAME}_revision_count"] -= 1
+                                    st.stop()
 
                                 st_store(ai_feedback, PHASE_NAME, "ai_response_revision_" + str(
                                     st.session_state[f"{PHASE_NAME}_revision_count"]))
@@ -0,0 +1,169 @@
+# Local first pass over student rationales, before (or instead of) the LLM. Each rationale is compared with
+# its case's reference justification by TF-IDF cosine similarity and its likert rating with the case's answer,
+# which sorts submissions into verdicts in well under a millisecond each:
+#   "blank"          - fewer than min_words words
+#   "restatement"    - at least restatement_overlap of its word trigrams appear verbatim in the case text
+#   "clear_match"    - likert matches the answer and similarity >= pass_similarity
+#   "clear_mismatch" - likert does not match and similarity <= fail_similarity
+#   "ambiguous"      - anything else; the ones worth an LLM call
+# See PREGRADE in config.py for the thresholds.
+
+import html
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+from scoring import likert_matches, likert_value
+
+# Verdicts where the submission is not a rationale yet, so the student is asked to try again
+SEND_BACK_VERDICTS = ("blank", "restatement")
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both
+but by can could did do does doing down during each few for from further had has have having he her here hers
+him his how i if in into is it its itself just me more most my no nor not now of off on once only or other our
+out over own same she should so some such than that the their them then there these they this those through to
+too under until up very was we were what when where which while who whom why will with would you your
+""".split())
+
+
+def words(text):
+    return TOKEN_PATTERN.findall(html.unescape(text or "").lower())
+
+
+def tokenize(text):
+    return [token for token in words(text) if len(token) > 1 and token not in STOP_WORDS]
+
+
+def trigrams(text_words):
+    return set(zip(text_words, text_words[1:], text_words[2:]))
+
+
+def reference_text(case):
+    expert_content = case.get("expert_content") or {}
+    return f"{case.get('justification', '')} {expert_content.get('justification', '')}"
+
+
+class ReferenceIndex:
+    # Each case's reference (its justification, plus the precomputed expert justification) as a sparse,
+    # L2-normalized TF-IDF row: a term -> weight dict, so memory grows with the words of the references rather
+    # than with cases x vocabulary. Submissions are scored a chunk at a time: the chunk's case rows and
+    # submission rows are laid out in dense float32 matrices over just the terms they use, and multiplied
+    # row-wise in one vectorized step.
+
+    def __init__(self, cases, chunk_size=1024):
+        self.chunk_size = chunk_size
+        term_counts = {}
+        document_frequency = Counter()
+        for case in cases:
+            counts = Counter(tokenize(reference_text(case)))
+            term_counts[case["id"]] = counts
+            document_frequency.update(counts.keys())
+        # Smoothed IDF, as in scikit-learn; words no reference uses cannot raise a similarity, so they are left out
+        self.idf = {term: math.log((1 + len(term_counts)) / (1 + frequency)) + 1
+                    for term, frequency in document_frequency.items()}
+        self.rows = {case_id: self.weights(counts) for case_id, counts in term_counts.items()}
+
+    def weights(self, counts):
+        # Sublinear term frequency, so repeating a word does not buy similarity
+        weights = {term: (1 + math.log(count)) * self.idf[term] for term, count in counts.items() if term in self.idf}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1
+        return {term: weight / norm for term, weight in weights.items()}
+
+    @staticmethod
+    def densify(rows, columns):
+        matrix = np.zeros((len(rows), len(columns)), dtype=np.float32)
+        for row, weights in enumerate(rows):
+            for term, weight in weights.items():
+                matrix[row, columns[term]] = weight
+        return matrix
+
+    def similarities(self, case_ids, token_lists):
+        # Cosine similarity of each tokenized submission with the reference of its case
+        scores = np.empty(len(token_lists), dtype=np.float32)
+        for start in range(0, len(token_lists), self.chunk_size):
+            end = start + self.chunk_size
+            references = [self.rows[case_id] for case_id in case_ids[start:end]]
+            submissions = [self.weights(Counter(tokens)) for tokens in token_lists[start:end]]
+            columns = {}
+            for weights in references:
+                for term in weights:
+                    columns.setdefault(term, len(columns))
+            # Submission terms outside the chunk's references multiply with zero, so they need no column
+            submissions = [{term: weight for term, weight in weights.items() if term in columns}
+                           for weights in submissions]
+            scores[start:end] = np.einsum("ij,ij->i", self.densify(references, columns),
+                                          self.densify(submissions, columns))
+        return scores
+
+
+def restatement_overlap(rationale, case):
+    # Share of the rationale's word trigrams (stop words included) copied verbatim from the case text. Reusing
+    # the case's terms in a sentence of one's own stays well under 0.5; pasting the case comes close to 1
+    rationale_trigrams = trigrams(words(rationale))
+    if not rationale_trigrams:
+        return 0.0
+    return len(rationale_trigrams & trigrams(words(case.get("case", "")))) / len(rationale_trigrams)
+
+
+def classify(case, likert, rationale, tokens, similarity, settings):
+    likert_match = likert_matches(likert, case["answer"]) if likert else None
+    if len(tokens) < settings.get("min_words", 4):
+        verdict = "blank"
+    elif restatement_overlap(rationale, case) >= settings.get("restatement_overlap", 0.8):
+        verdict = "restatement"
+    elif likert_match and similarity >= settings.get("pass_similarity", 0.35):
+        verdict = "clear_match"
+    elif likert_match is False and similarity <= settings.get("fail_similarity", 0.05):
+        verdict = "clear_mismatch"
+    else:
+        verdict = "ambiguous"
+    # Provisional score out of 1: half for the likert rating, half for how close the rationale comes to
+    # pass_similarity
+    score = 0.0
+    if verdict not in SEND_BACK_VERDICTS:
+        score = (0.5 if likert_match else 0.0) + 0.5 * min(1.0, similarity / settings.get("pass_similarity", 0.35))
+    return {
+        "verdict": verdict,
+        "similarity": round(similarity, 3),
+        "likert_match": likert_match,
+        "provisional_score": round(score, 3),
+    }
+
+
+def pregrade_batch(index, cases, likerts, rationales, settings):
+    # One result dict per submission; cases are the case dicts the rationales answer
+    token_lists = [tokenize(rationale) for rationale in rationales]
+    scores = index.similarities([case["id"] for case in cases], token_lists)
+    return [classify(case, likert, rationale, tokens, float(similarity), settings)
+            for case, likert, rationale, tokens, similarity in zip(cases, likerts, rationales, token_lists, scores)]
+
+
+def local_feedback(result, case, likert=None):
+    # Feedback in the sections the rationale prompt asks the model for, for verdicts decided locally
+    verdict = result["verdict"]
+    if verdict == "blank":
+        return ("Please explain your rating in a few sentences: which finding in the new information matters, "
+                "and how does it change the likelihood of the initial diagnosis?")
+    if verdict == "restatement":
+        return ("Your answer mostly repeats the case. Please explain your reasoning in your own words: why does "
+                "the new information make the initial diagnosis more likely, less likely, or neither?")
+    rating = likert_value(likert)
+    rating = likert if rating is None else f"{rating:+d}" if rating else "0"
+    if result["likert_match"]:
+        diagnosis = f"Your answer of {rating} matched the expected answer: {case['answer']}"
+    else:
+        diagnosis = f"Your answer of {rating} did not match the expected answer: {case['answer']}"
+    if verdict == "clear_match":
+        feedback = (f"Your rationale covers the key points of the expected justification: {case['justification']} "
+                    f"Keep weighing each new finding against the initial diagnosis like this.")
+    elif verdict == "clear_mismatch":
+        feedback = (f"Your rationale does not address the reasoning behind the expected answer: "
+                    f"{case['justification']} Look again at how this finding fits the initial diagnosis compared "
+                    f"with the alternatives.")
+    else:
+        feedback = f"Compare your rationale with the expected justification: {case['justification']}"
+    return f"**Diagnosis**\n\n{diagnosis}\n\n**Feedback**\n\n{feedback}"
@@ -0,0 +1,279 @@
+import asyncio
+import random
+import time
+
+from context_window import estimate_tokens, history_tokens
+
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504, 529)
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def error_status(error):
+    # openai/anthropic errors carry status_code, google.api_core errors an int code
+    status = getattr(error, "status_code", None)
+    if status is None and isinstance(getattr(error, "code", None), int):
+        status = error.code
+    return status
+
+
+def is_retryable(error):
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    # Connection resets and timeouts have no status code
+    return any(name in type(error).__name__ for name in ("Timeout", "Connection", "ServiceUnavailable"))
+
+
+def retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    # Refills continuously at rate_per_minute. Waiters queue on the lock, so they are served in order.
+    # The rate adapts: halved on every 429 and recovered step by step on successes.
+
+    def __init__(self, rate_per_minute):
+        self.configured_rate = rate_per_minute / 60
+        self.rate = self.configured_rate
+        self.capacity = rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def adjust(self, amount):
+        # Settle the difference between an estimate and the real usage; the balance may go negative
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+    def penalize(self):
+        self._refill()
+        self.rate = max(self.rate / 2, self.configured_rate / 10)
+        self.tokens = min(self.tokens, 0)
+
+    def reward(self):
+        self.rate = min(self.configured_rate, self.rate + self.configured_rate / 20)
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures; after cooldown one trial call is let through, and
+    # its outcome closes or reopens the breaker. A trial that never reports back (e.g. a cancelled hedge)
+    # is replaced by a new one after another cooldown.
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def check(self):
+        state = self.state
+        if state == "half_open":
+            now = time.monotonic()
+            if self.trial_started is None or now - self.trial_started >= self.cooldown:
+                self.trial_started = now
+                return
+        if state != "closed":
+            raise CircuitOpenError("Too many recent errors from this model, please try again shortly.")
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold or self.state == "half_open":
+            self.opened_at = time.monotonic()
+        self.trial_started = None
+
+
+class ModelLimiter:
+    def __init__(self, llm_configuration, settings):
+        self.settings = settings
+        rpm_limit = llm_configuration.get("rpm_limit")
+        tpm_limit = llm_configuration.get("tpm_limit")
+        self.requests = TokenBucket(rpm_limit) if rpm_limit else None
+        self.tokens = TokenBucket(tpm_limit) if tpm_limit else None
+        self.breaker = CircuitBreaker(settings.get("breaker_failure_threshold", 5),
+                                      settings.get("breaker_cooldown", 30))
+        self.metrics = {"calls": 0, "retries": 0, "rate_limited": 0, "failures": 0, "circuit_rejections": 0,
+                        "queue_wait_total": 0.0, "queue_wait_max": 0.0}
+
+    async def acquire(self, estimated_tokens):
+        started = time.monotonic()
+        if self.requests:
+            await self.requests.acquire()
+        if self.tokens:
+            await self.tokens.acquire(estimated_tokens)
+        waited = time.monotonic() - started
+        self.metrics["calls"] += 1
+        self.metrics["queue_wait_total"] += waited
+        self.metrics["queue_wait_max"] = max(self.metrics["queue_wait_max"], waited)
+        return waited
+
+    def backoff(self, attempt, error):
+        delay = retry_after(error)
+        if delay is None:
+            # Full jitter: uniform between 0 and the exponential cap
+            cap = min(self.settings.get("max_delay", 30), self.settings.get("base_delay", 1) * 2 ** attempt)
+            delay = random.uniform(0, cap)
+        return delay
+
+    def record_error(self, error):
+        if error_status(error) == 429:
+            self.metrics["rate_limited"] += 1
+            for bucket in (self.requests, self.tokens):
+                if bucket:
+                    bucket.penalize()
+
+    def record_failure(self, error):
+        # Only failures of the model count towards its breaker; a request it rejects (400, 401, 404, content
+        # policy) shows it is reachable, and must not lock every other session out of it
+        self.metrics["failures"] += 1
+        if is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def record_success(self, estimated_tokens, usage):
+        self.breaker.record_success()
+        for bucket in (self.requests, self.tokens):
+            if bucket:
+                bucket.reward()
+        if self.tokens and usage:
+            actual_tokens = sum(usage.get(key, 0) for key in
+                                ("input_tokens", "cached_tokens", "cache_write_tokens", "output_tokens"))
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+    def stats(self):
+        stats = dict(self.metrics)
+        stats["queue_wait_avg"] = stats["queue_wait_total"] / stats["calls"] if stats["calls"] else 0.0
+        stats["breaker"] = self.breaker.state
+        for name, bucket in (("rpm", self.requests), ("tpm", self.tokens)):
+            if bucket:
+                stats[f"{name}_current"] = round(bucket.rate * 60)
+        return stats
+
+
+class RateLimiterRegistry:
+    # One limiter per (provider, model) for the whole process. Every session's calls run on the shared
+    # event loop, so the buckets see the combined load of all sessions.
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._limiters = {}
+
+    def get(self, llm_configuration):
+        key = (llm_configuration["provider"], llm_configuration["model"])
+        if key not in self._limiters:
+            self._limiters[key] = ModelLimiter(llm_configuration, self.settings)
+        return self._limiters[key]
+
+    def stats(self):
+        return {f"{provider}/{model}": limiter.stats() for (provider, model), limiter in list(self._limiters.items())}
+
+
+class RateLimitedAdapter:
+    # Wraps an LLMAdapter: waits for rate limit capacity, retries 429/5xx/timeouts with jittered
+    # exponential backoff and fails fast while the model's circuit breaker is open.
+    # The time spent waiting for capacity is reported as "queue_seconds" in the completion / usage.
+
+    def __init__(self, adapter, limiters):
+        self.adapter = adapter
+        self.limiters = limiters
+        self.provider = adapter.provider
+        self.display_name = adapter.display_name
+
+    def estimate(self, llm_configuration, system_prompt, chat_history, user_prompt):
+        return estimate_tokens(system_prompt) + history_tokens(chat_history) + estimate_tokens(user_prompt) \
+            + llm_configuration.get("max_tokens", 1000)
+
+    async def complete(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                       json_mode=False):
+        limiter = self.limiters.get(llm_configuration)
+        estimated_tokens = self.estimate(llm_configuration, system_prompt, chat_history, user_prompt)
+        attempt = 0
+        queue_seconds = 0.0
+        while True:
+            self.check_breaker(limiter)
+            queue_seconds += await limiter.acquire(estimated_tokens)
+            try:
+                completion = await self.adapter.complete(llm_configuration, system_prompt, chat_history,
+                                                         user_prompt, image_url, json_mode)
+            except Exception as e:
+                attempt = await self.handle_error(limiter, e, attempt)
+                continue
+            limiter.record_success(estimated_tokens, completion)
+            return dict(completion, queue_seconds=queue_seconds)
+
+    async def stream(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                     json_mode=False, usage=None):
+        limiter = self.limiters.get(llm_configuration)
+        estimated_tokens = self.estimate(llm_configuration, system_prompt, chat_history, user_prompt)
+        attempt = 0
+        queue_seconds = 0.0
+        while True:
+            self.check_breaker(limiter)
+            queue_seconds += await limiter.acquire(estimated_tokens)
+            started = False
+            try:
+                async for text in self.adapter.stream(llm_configuration, system_prompt, chat_history, user_prompt,
+                                                      image_url, json_mode, usage=usage):
+                    started = True
+                    yield text
+            except Exception as e:
+                # Text already shown to the student cannot be taken back, so only retry before the first chunk
+                if started:
+                    limiter.record_failure(e)
+                    raise
+                attempt = await self.handle_error(limiter, e, attempt)
+                continue
+            limiter.record_success(estimated_tokens, usage)
+            if usage is not None:
+                usage["queue_seconds"] = queue_seconds
+            return
+
+    def check_breaker(self, limiter):
+        try:
+            limiter.breaker.check()
+        except CircuitOpenError:
+            limiter.metrics["circuit_rejections"] += 1
+            raise
+
+    async def handle_error(self, limiter, error, attempt):
+        limiter.record_error(error)
+        if not is_retryable(error) or attempt >= limiter.settings.get("max_retries", 4):
+            limiter.record_failure(error)
+            raise error
+        limiter.metrics["retries"] += 1
+        await asyncio.sleep(limiter.backoff(attempt, error))
+        return attempt + 1
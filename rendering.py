@@ -0,0 +1,80 @@
+import functools
+import math
+import re
+import time
+
+import streamlit as st
+
+# Bold phase field labels, except the options of radio groups. Scoped to the main area so the
+# sidebar controls keep the default look.
+FIELD_LABEL_CSS = """
+<style>
+[data-testid="stMain"] label p, section.main label p {
+    font-weight: bold;
+    font-size: 16px;
+}
+
+[data-testid="stMain"] div[role="radiogroup"] label p, section.main div[role="radiogroup"] label p {
+    font-weight: unset !important;
+    font-size: unset !important;
+}
+</style>
+"""
+
+
+def inject_field_styles():
+    # One style element per script run instead of one stylable_container per field
+    st.markdown(FIELD_LABEL_CSS, unsafe_allow_html=True)
+
+
+def split_reveal_units(message, unit):
+    # Zero-width splits keep every character, so joining the units gives back the message
+    if unit == "sentence":
+        return re.split(r'(?<=[.!?])(?=\s)', message)
+    return re.split(r'(?<=\s)(?=\S)', message)
+
+
+def reveal_frames(message, unit="word", frame_rate=30):
+    delay = 1 / frame_rate if frame_rate else 0
+    for index, chunk in enumerate(split_reveal_units(message, unit)):
+        if index and delay:
+            time.sleep(delay)
+        yield chunk
+
+
+def reveal_message(res_box, message, reveal_config):
+    # "instant" sends one update, "chunked" one per word/sentence at the frame rate and
+    # "write_stream" hands the same frames to st.write_stream
+    mode = reveal_config.get("mode", "instant")
+    unit = reveal_config.get("unit", "word")
+    frame_rate = reveal_config.get("frame_rate", 30)
+    if mode == "chunked":
+        parts = []
+        for chunk in reveal_frames(message, unit, frame_rate):
+            parts.append(chunk)
+            res_box.info(body="".join(parts), icon="🤖")
+    elif mode == "write_stream":
+        with res_box.container():
+            st.write_stream(reveal_frames(message, unit, frame_rate))
+    else:
+        res_box.info(body=message, icon="🤖")
+
+
+@functools.lru_cache(maxsize=1024)
+def render_turn(user, assistant):
+    # One markdown string per chat turn, built once; strings cache their hash, so looking a turn up on
+    # later reruns is cheap however long it is
+    return f"**User:** {user}\n\n**AI:** {assistant}\n\n---\n\n"
+
+
+def history_page_count(chat_history, page_size):
+    return max(1, math.ceil(len(chat_history) / page_size))
+
+
+def history_page(chat_history, page, page_size):
+    # Page 1 holds the latest page_size turns, oldest first. Returns the page as one markdown string and
+    # the (1-based) numbers of its first and last turn
+    end = max(0, len(chat_history) - (page - 1) * page_size)
+    start = max(0, end - page_size)
+    markdown = "".join(render_turn(turn["user"], turn["assistant"]) for turn in chat_history[start:end])
+    return markdown, start + 1, end
@@ -0,0 +1,232 @@
+import asyncio
+import bisect
+import time
+
+TEXT, DONE, COMPLETION, ERROR = "text", "done", "completion", "error"
+
+# Settings the session picked for its model (the sidebar sliders), which fallback and hedge models answer with
+# too; prices and everything else stay the answering model's own
+SESSION_SETTINGS = ("temperature", "max_tokens", "top_p", "frequency_penalty", "presence_penalty")
+
+
+class LatencyHistogram:
+    # Log-spaced buckets from 50 ms to ~5 minutes. Counts decay on every observation, so the
+    # quantiles follow a provider that slows down instead of averaging over its whole history.
+    BOUNDS = tuple(0.05 * 1.25 ** i for i in range(40))
+
+    def __init__(self, decay=0.99):
+        self.decay = decay
+        self.counts = [0.0] * (len(self.BOUNDS) + 1)
+        self.observations = 0
+
+    def observe(self, seconds):
+        self.counts = [count * self.decay for count in self.counts]
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.observations += 1
+
+    def quantile(self, q):
+        target = q * sum(self.counts)
+        cumulative = 0.0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return self.BOUNDS[-1]
+
+
+class LatencyTracker:
+    # Time to first token (streams) and total latency (plain completions) per (provider, model)
+
+    def __init__(self):
+        self.histograms = {}
+
+    def histogram(self, llm_configuration, kind):
+        key = (llm_configuration["provider"], llm_configuration["model"], kind)
+        if key not in self.histograms:
+            self.histograms[key] = LatencyHistogram()
+        return self.histograms[key]
+
+    def stats(self):
+        return {f"{provider}/{model} {kind}": {"observations": histogram.observations,
+                                               "p50": round(histogram.quantile(0.5), 3),
+                                               "p95": round(histogram.quantile(0.95), 3)}
+                for (provider, model, kind), histogram in list(self.histograms.items())}
+
+
+def with_session_settings(configuration, llm_configuration):
+    return dict(configuration, **{key: llm_configuration[key] for key in SESSION_SETTINGS if key in llm_configuration})
+
+
+def routing_policy(llm_configuration, phase_name=None):
+    routing = llm_configuration.get("routing", {})
+    return routing.get(phase_name, routing.get("default", {}))
+
+
+class Attempt:
+    # One request to one model, run in its own task and read through a queue, so it can race
+    # another attempt and be cancelled cleanly when it loses. status is None while it runs, then "ok",
+    # "error" or "cancelled"; on_end, when given, is called with the attempt once it has ended.
+
+    def __init__(self, name, adapter, llm_configuration, request, mode, latencies, on_end=None):
+        self.name = name
+        self.llm_configuration = llm_configuration
+        self.mode = mode
+        self.usage = {}
+        self.output = []
+        self.status = None
+        self.on_end = on_end
+        self.queue = asyncio.Queue()
+        self.started = time.monotonic()
+        self.histogram = latencies.histogram(llm_configuration, "ttft" if mode == "stream" else "latency")
+        self.answered = False
+        self.task = asyncio.ensure_future(self.run(adapter, request))
+        self.head = asyncio.ensure_future(self.queue.get())
+
+    async def run(self, adapter, request):
+        try:
+            if self.mode == "stream":
+                async for text in adapter.stream(self.llm_configuration, *request, usage=self.usage):
+                    self.record_answer()
+                    self.output.append(text)
+                    await self.queue.put((TEXT, text))
+                await self.queue.put((DONE, None))
+            else:
+                completion = await adapter.complete(self.llm_configuration, *request)
+                self.record_answer()
+                self.usage = completion
+                await self.queue.put((COMPLETION, completion))
+        except Exception as e:
+            await self.queue.put((ERROR, e))
+
+    def record_answer(self):
+        if not self.answered:
+            self.answered = True
+            self.histogram.observe(time.monotonic() - self.started)
+
+    def end(self, status):
+        if self.status is None:
+            self.status = status
+            if self.on_end:
+                self.on_end(self)
+
+    def cancel(self):
+        if not self.answered:
+            # A lower bound, but leaving losers out would make the model look faster than it is
+            self.histogram.observe(time.monotonic() - self.started)
+        self.task.cancel()
+        self.head.cancel()
+        self.end("cancelled")
+
+
+class Router:
+    # Sends a call to the session's model and, per the model's "routing" policy, falls back to the next
+    # model in "fallback" when it fails, or races a "hedge" model against it when the first token is late.
+    # Completions and stream usage carry "served_by": None for the session's model, else the fallback's name.
+    # plan, when given, is called with each fallback and hedge configuration before it is sent and returns the
+    # configuration to send instead (e.g. with max_tokens clamped), or None to skip that model; on_end is called
+    # with every attempt once it has ended, losers and failures included.
+
+    def __init__(self, llm_configurations, adapters, latencies=None):
+        self.llm_configurations = llm_configurations
+        self.adapters = adapters
+        self.latencies = latencies or LatencyTracker()
+        self.metrics = {"fallbacks": 0, "hedges": 0, "hedge_wins": 0}
+
+    def candidates(self, llm_configuration, policy, image_url):
+        candidates = [(None, llm_configuration)]
+        for name in policy.get("fallback", []):
+            fallback_configuration = with_session_settings(self.llm_configurations[name], llm_configuration)
+            if not image_url or fallback_configuration.get("supports_images", False):
+                candidates.append((name, fallback_configuration))
+        return candidates
+
+    def hedge_delay(self, llm_configuration, hedge, mode):
+        histogram = self.latencies.histogram(llm_configuration, "ttft" if mode == "stream" else "latency")
+        if histogram.observations < hedge.get("min_samples", 20):
+            return hedge.get("delay_ms", 2000) / 1000
+        delay = histogram.quantile(hedge.get("quantile", 0.95))
+        return min(max(delay, hedge.get("min_delay_ms", 500) / 1000), hedge.get("max_delay_ms", 10000) / 1000)
+
+    def start(self, name, llm_configuration, request, mode, on_end=None):
+        adapter = self.adapters[llm_configuration["provider"]]
+        return Attempt(name, adapter, llm_configuration, request, mode, self.latencies, on_end)
+
+    async def first_answer(self, name, llm_configuration, request, mode, hedge, errors, plan=None, on_end=None):
+        # Returns (attempt, first queue item) of whichever attempt answers first, or None if all failed
+        pending = {}
+        attempt = self.start(name, llm_configuration, request, mode, on_end)
+        pending[attempt.head] = attempt
+        timeout = self.hedge_delay(llm_configuration, hedge, mode) if hedge else None
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                timeout = None
+                hedge_configuration = with_session_settings(self.llm_configurations[hedge["model"]], llm_configuration)
+                if plan:
+                    hedge_configuration = plan(hedge_configuration)
+                if hedge_configuration is None:
+                    continue
+                self.metrics["hedges"] += 1
+                hedge_attempt = self.start(hedge["model"], hedge_configuration, request, mode, on_end)
+                pending[hedge_attempt.head] = hedge_attempt
+                continue
+            for head in done:
+                attempt = pending.pop(head)
+                kind, value = head.result()
+                if kind == ERROR:
+                    attempt.end("error")
+                    errors.append(value)
+                    continue
+                for loser in pending.values():
+                    loser.cancel()
+                if hedge and attempt.name == hedge["model"]:
+                    self.metrics["hedge_wins"] += 1
+                return attempt, (kind, value)
+        return None
+
+    async def route(self, llm_configuration, request, mode, phase_name, image_url, plan=None, on_end=None):
+        policy = routing_policy(llm_configuration, phase_name)
+        errors = []
+        for index, (name, candidate_configuration) in enumerate(self.candidates(llm_configuration, policy, image_url)):
+            if index:
+                if plan:
+                    candidate_configuration = plan(candidate_configuration)
+                if candidate_configuration is None:
+                    continue
+                self.metrics["fallbacks"] += 1
+            # Only the session's own model is hedged; fallbacks already mean the call is late
+            hedge = policy.get("hedge") if index == 0 else None
+            if hedge and image_url and not self.llm_configurations[hedge["model"]].get("supports_images", False):
+                hedge = None
+            answer = await self.first_answer(name, candidate_configuration, request, mode, hedge, errors, plan, on_end)
+            if answer:
+                return answer
+        raise errors[-1]
+
+    async def complete(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                       json_mode=False, phase_name=None, plan=None, on_end=None):
+        request = (system_prompt, chat_history, user_prompt, image_url, json_mode)
+        attempt, (kind, completion) = await self.route(llm_configuration, request, "complete", phase_name, image_url,
+                                                       plan, on_end)
+        attempt.end("ok")
+        return dict(completion, served_by=attempt.name)
+
+    async def stream(self, llm_configuration, system_prompt, chat_history, user_prompt, image_url=None,
+                     json_mode=False, usage=None, phase_name=None, plan=None, on_end=None):
+        request = (system_prompt, chat_history, user_prompt, image_url, json_mode)
+        attempt, (kind, value) = await self.route(llm_configuration, request, "stream", phase_name, image_url, plan,
+                                                  on_end)
+        try:
+            while kind != DONE:
+                if kind == ERROR:
+                    raise value
+                yield value
+                kind, value = await attempt.queue.get()
+        finally:
+            attempt.task.cancel()
+            attempt.end({DONE: "ok", ERROR: "error"}.get(kind, "cancelled"))
+        if usage is not None:
+            usage.update(attempt.usage, served_by=attempt.name)
+
+    def stats(self):
+        return dict(self.metrics, latency=self.latencies.stats())
@@ -0,0 +1,49 @@
+import json
+import re
+
+
+def build_scoring_instructions(rubric):
+    scoring_instructions = f"""
+    Please score the user's previous response based on the following rubric: \n{rubric}
+    \n\nPlease output your response as JSON, using this format: {{ "[criteria 1]": "[score 1]", "[criteria 2]": "[score 2]", "total": "[total score]" }}
+    """
+    return scoring_instructions
+
+
+def build_structured_scoring_instructions(phase_instructions, rubric):
+    structured_instructions = f"""{phase_instructions}
+    \n\nAlso score the user's response based on the following rubric: \n{rubric}
+    \n\nPlease output your response as JSON, using this format: {{ "feedback": "[your feedback]", "scores": {{ "[criteria 1]": "[score 1]", "[criteria 2]": "[score 2]", "total": "[total score]" }} }}
+    """
+    return structured_instructions
+
+
+def parse_structured_feedback(text):
+    # Split a single-call response into the feedback and a scoring JSON string extract_score understands
+    try:
+        # Models without a JSON mode sometimes wrap the object in prose or code fences
+        data = json.loads(text[text.find("{"):text.rfind("}") + 1])
+        return data.get("feedback", ""), json.dumps(data.get("scores", {}))
+    except (TypeError, ValueError, AttributeError):
+        return text, text
+
+
+def extract_score(text):
+    if not text:
+        return 0
+    pattern = r'"total":\s*"?(\d+)"?'
+    match = re.search(pattern, text)
+    if match:
+        return int(match.group(1))
+    else:
+        return 0
+
+
+def likert_value(text):
+    # "+1 More likely" -> 1, "The diagnosis becomes less likely (-1)." -> -1
+    match = re.search(r'([+-]?[01])\b', text or "")
+    return int(match.group(1)) if match else None
+
+
+def likert_matches(likert, answer):
+    return likert_value(likert) is not None and likert_value(likert) == likert_value(answer)
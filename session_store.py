@@ -0,0 +1,235 @@
+import atexit
+import json
+import logging
+import threading
+import time
+
+from storage import build_backend, connect_shared
+
+# Session state keys that make up a student's progress; every key starting with "<phase name>_"
+# (answers, AI responses, scores, revision counters, phase status) is persisted as well
+SESSION_KEYS = ("CURRENT_PHASE", "chat_history", "additional_prompt", "TOTAL_PRICE", "CACHE_HITS", "CACHE_MISSES", "TOKENS_SAVED",
+                "LAST_TOKENS_SAVED", "HISTORY_SUMMARY", "random_key", "case_seed", "selected_llm", "score",
+                "ai_score", "cohort")
+
+logger = logging.getLogger("msct.session_store")
+
+
+def persisted_state(session_state, phase_names):
+    prefixes = tuple(f"{phase_name}_" for phase_name in phase_names)
+    return {key: session_state[key] for key in list(session_state.keys())
+            if key in SESSION_KEYS or (isinstance(key, str) and key.startswith(prefixes))}
+
+
+def changed_values(state, written):
+    # JSON of every value that differs from what was last checkpointed; written maps key -> hash of that JSON
+    changes = {}
+    for key, value in state.items():
+        encoded = json.dumps(value, ensure_ascii=False, default=str)
+        fingerprint = hash(encoded)
+        if written.get(key) != fingerprint:
+            changes[key] = encoded
+            written[key] = fingerprint
+    return changes
+
+
+class SQLiteSessionBackend:
+    # One row per (session, key) in an SQLite file shared by the workers on a host
+
+    def __init__(self, path="sessions.sqlite3", ttl_seconds=7 * 24 * 60 * 60, **kwargs):
+        self.ttl_seconds = ttl_seconds
+        self._last_expiry = 0
+        self._lock = threading.Lock()
+        self._conn = connect_shared(
+            path,
+            "CREATE TABLE IF NOT EXISTS session_state ("
+            "session_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (session_id, key))",
+            "CREATE INDEX IF NOT EXISTS session_state_updated_at ON session_state (updated_at)",
+        )
+
+    def read(self, session_id):
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM session_state WHERE session_id = ?",
+                                      (session_id,)).fetchall()
+        return dict(rows)
+
+    def write(self, batch):
+        now = time.time()
+        rows = [(session_id, key, value, now) for session_id, values in batch.items() for key, value in values.items()]
+        with self._lock:
+            # The connection commits on success and rolls back when the batch fails, so a failed flush
+            # never leaves the shared connection inside an open transaction
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany("INSERT OR REPLACE INTO session_state VALUES (?, ?, ?, ?)", rows)
+            if self.ttl_seconds and now - self._last_expiry > 60 * 60:
+                # Drop whole sessions that have not been written to for ttl_seconds
+                self._last_expiry = now
+                self._conn.execute(
+                    "DELETE FROM session_state WHERE session_id IN (SELECT session_id FROM session_state "
+                    "GROUP BY session_id HAVING max(updated_at) < ?)", (now - self.ttl_seconds,))
+
+
+class LocalRedis:
+    # In-process stand-in for the handful of Redis commands RedisSessionBackend uses, so the Redis code
+    # path runs in development and tests without a server (url "memory://")
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._hashes = {}
+        self._expires_at = {}
+
+    def _expire_stale(self, name):
+        if name in self._expires_at and self._expires_at[name] <= time.time():
+            self._hashes.pop(name, None)
+            self._expires_at.pop(name, None)
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        with self._lock:
+            self._expire_stale(name)
+            values = self._hashes.setdefault(name, {})
+            if key is not None:
+                values[key] = value
+            values.update(mapping or {})
+
+    def hgetall(self, name):
+        with self._lock:
+            self._expire_stale(name)
+            return dict(self._hashes.get(name, {}))
+
+    def expire(self, name, seconds):
+        with self._lock:
+            self._expires_at[name] = time.time() + seconds
+
+    def pipeline(self):
+        return LocalPipeline(self)
+
+
+class LocalPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def hset(self, *args, **kwargs):
+        self.commands.append(("hset", args, kwargs))
+        return self
+
+    def expire(self, *args, **kwargs):
+        self.commands.append(("expire", args, kwargs))
+        return self
+
+    def execute(self):
+        with self.client._lock:
+            results = [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class RedisSessionBackend:
+    # One Redis hash per session, shared by workers on every host; the hash expires ttl_seconds after its
+    # last write
+
+    def __init__(self, url="redis://localhost:6379/0", ttl_seconds=7 * 24 * 60 * 60, key_prefix="msct:session:",
+                 **kwargs):
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+        if url.startswith("memory://"):
+            self.client = LocalRedis()
+        else:
+            import redis
+            self.client = redis.Redis.from_url(url, decode_responses=True)
+
+    def read(self, session_id):
+        return self.client.hgetall(self.key_prefix + session_id)
+
+    def write(self, batch):
+        pipeline = self.client.pipeline()
+        for session_id, values in batch.items():
+            pipeline.hset(self.key_prefix + session_id, mapping=values)
+            if self.ttl_seconds:
+                pipeline.expire(self.key_prefix + session_id, int(self.ttl_seconds))
+        pipeline.execute()
+
+
+class SessionStore:
+    # Write-behind front for a backend: checkpoints are merged per session and key in memory and written
+    # in one batch every flush_interval seconds (or as soon as max_batch keys are waiting) by a daemon
+    # thread, so script runs never wait on the store
+
+    def __init__(self, backend, flush_interval=1.0, max_batch=500):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_keys = 0
+        self._in_flight = {}
+        self._wake = threading.Event()
+        self.stats = {"checkpoints": 0, "flushes": 0, "keys_written": 0, "write_errors": 0, "rehydrated": 0}
+        threading.Thread(target=self._run, name="session-store-flush", daemon=True).start()
+        atexit.register(self.flush)
+
+    def checkpoint(self, session_id, changes):
+        if not changes:
+            return
+        with self._lock:
+            pending = self._pending.setdefault(session_id, {})
+            self._pending_keys += len(changes.keys() - pending.keys())
+            pending.update(changes)
+            self.stats["checkpoints"] += 1
+            if self._pending_keys >= self.max_batch:
+                self._wake.set()
+
+    def load(self, session_id):
+        values = self.backend.read(session_id)
+        with self._lock:
+            # Checkpoints of this worker that are not written yet are newer than the backend
+            values.update(self._in_flight.get(session_id, {}))
+            values.update(self._pending.get(session_id, {}))
+        if values:
+            self.stats["rehydrated"] += 1
+        return {key: json.loads(value) for key, value in values.items()}
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending, self._pending_keys = self._pending, {}, 0
+            self._in_flight = batch
+        try:
+            self.backend.write(batch)
+        except Exception as e:
+            logger.warning(f"Session checkpoint failed, retrying with the next flush: {e}")
+            with self._lock:
+                self.stats["write_errors"] += 1
+                for session_id, values in batch.items():
+                    # Keep anything checkpointed since, it is newer
+                    pending = self._pending.setdefault(session_id, {})
+                    for key, value in values.items():
+                        if key not in pending:
+                            pending[key] = value
+                            self._pending_keys += 1
+                self._in_flight = {}
+            return
+        with self._lock:
+            self._in_flight = {}
+        self.stats["flushes"] += 1
+        self.stats["keys_written"] += sum(len(values) for values in batch.values())
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+SESSION_BACKENDS = {
+    "sqlite": SQLiteSessionBackend,
+    "redis": RedisSessionBackend,
+}
+
+
+def build_session_store(store_config):
+    backend = build_backend(SESSION_BACKENDS, store_config, "session store", "sqlite")
+    return SessionStore(backend, store_config.get("flush_interval", 1.0), store_config.get("max_batch", 500))
@@ -0,0 +1,21 @@
+import sqlite3
+
+
+def connect_shared(path, *schema):
+    # Connection to an SQLite file shared by every worker on the host: autocommit, WAL so readers never block
+    # the writer, up to 30 s waiting for another worker's lock, and usable from any thread (callers serialize
+    # their own use with a lock). The schema statements should be idempotent (CREATE ... IF NOT EXISTS).
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in schema:
+        conn.execute(statement)
+    return conn
+
+
+def build_backend(backends, backend_config, kind, default):
+    # Builds backend_config["backend"] from backends with the rest of the config as keyword arguments;
+    # backends take **kwargs, so settings meant for their caller are ignored
+    backend = backend_config.get("backend", default)
+    if backend not in backends:
+        raise ValueError(f"Unknown {kind} backend: {backend}")
+    return backends[backend](**{k: v for k, v in backend_config.items() if k not in ("enabled", "backend")})
@@ -0,0 +1,154 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+TOKEN_TYPES = ("input_tokens", "cached_tokens", "cache_write_tokens", "output_tokens")
+TIMINGS = {
+    "latency": "Total time of an LLM call",
+    "ttft": "Time to the first streamed token of an LLM call",
+    "queue": "Time an LLM call waited for rate limit capacity",
+}
+LABELS = ("phase", "provider", "model")
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        # Linear interpolation inside the bucket, like Prometheus' histogram_quantile
+        target = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), self.counts):
+            if count and cumulative + count >= target:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (target - cumulative) / count
+            cumulative += count
+            lower = bound
+        return lower
+
+
+def format_labels(labels):
+    return ",".join(f'{name}="{value}"' for name, value in labels)
+
+
+class Telemetry:
+    # Process-wide aggregation of per-call records plus one JSON log line per call.
+    # Records come from every session's script thread, the /metrics server reads from its own.
+
+    def __init__(self, log_calls=True, logger_name="msct.llm"):
+        self.log_calls = log_calls
+        self.logger = logging.getLogger(logger_name)
+        if not self.logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.tokens = {}
+        self.cost = {}
+        self.histograms = {timing: {} for timing in TIMINGS}
+
+    def record(self, call):
+        key = tuple((label, call.get(label) or "") for label in LABELS)
+        with self._lock:
+            status_key = key + (("status", call["status"]),)
+            self.calls[status_key] = self.calls.get(status_key, 0) + 1
+            for token_type in TOKEN_TYPES:
+                if call.get(token_type):
+                    token_key = key + (("type", token_type[:-len("_tokens")]),)
+                    self.tokens[token_key] = self.tokens.get(token_key, 0) + call[token_type]
+            self.cost[key] = self.cost.get(key, 0.0) + call.get("cost", 0.0)
+            if call["status"] == "ok":
+                for timing in TIMINGS:
+                    if call.get(f"{timing}_seconds") is not None:
+                        self.histograms[timing].setdefault(key, Histogram()).observe(call[f"{timing}_seconds"])
+        if self.log_calls:
+            self.logger.info(json.dumps(dict(call, event="llm_call", timestamp=time.time())))
+
+    def summary(self):
+        # {"phase / provider/model": {"calls", "latency_p50", "latency_p95", "ttft_p50", ...}}
+        with self._lock:
+            summary = {}
+            for timing, histograms in self.histograms.items():
+                for key, histogram in histograms.items():
+                    labels = dict(key)
+                    row = summary.setdefault(f"{labels['phase']} / {labels['provider']}/{labels['model']}",
+                                             {"calls": 0})
+                    row["calls"] = max(row["calls"], histogram.count)
+                    row[f"{timing}_p50"] = round(histogram.quantile(0.5), 3)
+                    row[f"{timing}_p95"] = round(histogram.quantile(0.95), 3)
+            return summary
+
+    def exposition(self):
+        # Prometheus text format 0.0.4
+        lines = []
+        with self._lock:
+            lines += ["# HELP msct_llm_calls_total LLM calls by outcome", "# TYPE msct_llm_calls_total counter"]
+            lines += [f"msct_llm_calls_total{{{format_labels(key)}}} {value}" for key, value in self.calls.items()]
+            lines += ["# HELP msct_llm_tokens_total Tokens billed for LLM calls", "# TYPE msct_llm_tokens_total counter"]
+            lines += [f"msct_llm_tokens_total{{{format_labels(key)}}} {value}" for key, value in self.tokens.items()]
+            lines += ["# HELP msct_llm_cost_dollars_total Cost of LLM calls in USD",
+                      "# TYPE msct_llm_cost_dollars_total counter"]
+            lines += [f"msct_llm_cost_dollars_total{{{format_labels(key)}}} {value:.6f}"
+                      for key, value in self.cost.items()]
+            for timing, description in TIMINGS.items():
+                name = f"msct_llm_{timing}_seconds"
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+                for key, histogram in self.histograms[timing].items():
+                    labels = format_labels(key)
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(f"{name}_sum{{{labels}}} {histogram.total:.6f}")
+                    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(telemetry, host, port):
+    # Streamlit has no custom routes, so /metrics gets its own small HTTP server in a daemon thread
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = telemetry.exposition().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+def timed_chunks(chunks, started, timing):
+    # Passes stream chunks through, noting the time to the first one in timing["ttft_seconds"]
+    for chunk in chunks:
+        if "ttft_seconds" not in timing:
+            timing["ttft_seconds"] = time.monotonic() - started
+        yield chunk